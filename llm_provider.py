@@ -2,26 +2,73 @@
 LLM Provider for Llama-3.1-8B-Instruct
 Supports both local inference and API-based inference (e.g., Ollama, vLLM)
 """
+import asyncio
 import json
-from typing import List, Dict, Optional
+import hashlib
+import shelve
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Iterator
 from abc import ABC, abstractmethod
 
+try:
+    # Optional: faster parsing of streamed chunks and cache keys
+    import orjson
+except ImportError:
+    orjson = None
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
 
 class LLMProvider(ABC):
     """Base class for LLM providers"""
 
+    # Context window of the model in tokens (prompt + response), None if unknown
+    context_window: Optional[int] = None
+
     @abstractmethod
     def generate(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> str:
         """Generate response from messages"""
         pass
 
+    def generate_stream(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> Iterator[str]:
+        """Generate response from messages, yielding text chunks as they arrive"""
+        # Default for providers without streaming support: a single chunk
+        yield self.generate(messages, max_tokens=max_tokens, temperature=temperature)
+
+    async def agenerate(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> str:
+        """Generate response without blocking the event loop"""
+        return await asyncio.to_thread(self.generate, messages, max_tokens=max_tokens, temperature=temperature)
+
+    def batch_generate(self, batch: List[List[Dict[str, str]]], max_tokens: int = 512,
+                       temperature: float = 0.7, max_workers: int = 8) -> List[str]:
+        """
+        Generate one response per message list, in order
+        Requests are sent concurrently, so servers with continuous batching
+        (vLLM, Ollama with OLLAMA_NUM_PARALLEL) process them together
+        """
+        if len(batch) <= 1:
+            return [self.generate(messages, max_tokens=max_tokens, temperature=temperature) for messages in batch]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batch))) as executor:
+            return list(executor.map(
+                lambda messages: self.generate(messages, max_tokens=max_tokens, temperature=temperature),
+                batch
+            ))
+
 
 class OllamaProvider(LLMProvider):
     """Provider for Ollama API (recommended for ease of use)"""
 
-    def __init__(self, base_url: str = "http://localhost:11434", model_name: str = "llama3.2:3b"):
+    def __init__(self, base_url: str = "http://localhost:11434", model_name: str = "llama3.2:3b",
+                 num_ctx: int = 8192):
+        """
+        Args:
+            num_ctx: Context window requested to Ollama (its own default is
+                smaller than the system prompt of the full menu)
+        """
         self.base_url = base_url
         self.model_name = model_name
+        self.context_window = num_ctx
 
     def generate(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> str:
         """Generate response using Ollama API"""
@@ -36,7 +83,8 @@ class OllamaProvider(LLMProvider):
                     "stream": False,
                     "options": {
                         "temperature": temperature,
-                        "num_predict": max_tokens
+                        "num_predict": max_tokens,
+                        "num_ctx": self.context_window
                     }
                 },
                 timeout=60
@@ -46,6 +94,40 @@ class OllamaProvider(LLMProvider):
         except Exception as e:
             raise RuntimeError(f"Error calling Ollama API: {e}")
 
+    def generate_stream(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> Iterator[str]:
+        """Stream response chunks from the Ollama API"""
+        import requests
+
+        try:
+            with requests.post(
+                f"{self.base_url}/api/chat",
+                json={
+                    "model": self.model_name,
+                    "messages": messages,
+                    "stream": True,
+                    "options": {
+                        "temperature": temperature,
+                        "num_predict": max_tokens,
+                        "num_ctx": self.context_window
+                    }
+                },
+                stream=True,
+                timeout=60
+            ) as response:
+                response.raise_for_status()
+                # One JSON object per line, the last one has "done": true
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    data = _json_loads(line)
+                    content = data.get("message", {}).get("content")
+                    if content:
+                        yield content
+                    if data.get("done"):
+                        break
+        except Exception as e:
+            raise RuntimeError(f"Error calling Ollama API: {e}")
+
 
 class HuggingFaceProvider(LLMProvider):
     """Provider for local Hugging Face transformers inference"""
@@ -67,6 +149,7 @@ class HuggingFaceProvider(LLMProvider):
             low_cpu_mem_usage=True
         )
         self.device = self.model.device
+        self.context_window = getattr(self.model.config, "max_position_embeddings", None)
         print("Model loaded successfully!")
 
     def generate(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> str:
@@ -100,17 +183,28 @@ class HuggingFaceProvider(LLMProvider):
 
         return response.strip()
 
+    def batch_generate(self, batch: List[List[Dict[str, str]]], max_tokens: int = 512,
+                       temperature: float = 0.7, max_workers: int = 8) -> List[str]:
+        """
+        Generate one response per message list, one after the other
+        Concurrent generate calls on a single local model only contend for it
+        """
+        return [self.generate(messages, max_tokens=max_tokens, temperature=temperature) for messages in batch]
+
 
 class OpenAICompatibleProvider(LLMProvider):
     """Provider per OpenAI API ufficiale e compatibili (vLLM, LM Studio, ecc.)"""
 
-    def __init__(self, base_url: str = None, api_key: str = "dummy", model_name: str = "llama-3.1-8b-instruct"):
+    def __init__(self, base_url: str = None, api_key: str = "dummy", model_name: str = "llama-3.1-8b-instruct",
+                 context_window: Optional[int] = None):
         # Se non specificato, usa l'endpoint OpenAI ufficiale
         if base_url is None:
             base_url = "https://api.openai.com/v1"
         self.base_url = base_url
         self.api_key = api_key
         self.model_name = model_name
+        # Contesto del modello servito (es. --max-model-len di vLLM), se noto
+        self.context_window = context_window
 
     def generate(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> str:
         import requests
@@ -134,13 +228,148 @@ class OpenAICompatibleProvider(LLMProvider):
         except Exception as e:
             raise RuntimeError(f"Error calling OpenAI-compatible API: {e}")
 
+    def generate_stream(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> Iterator[str]:
+        """Stream response chunks via server-sent events"""
+        import requests
+        try:
+            with requests.post(
+                f"{self.base_url}/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                },
+                json={
+                    "model": self.model_name,
+                    "messages": messages,
+                    "max_tokens": max_tokens,
+                    "temperature": temperature,
+                    "stream": True
+                },
+                stream=True,
+                timeout=60
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith(b"data: "):
+                        continue
+                    payload = line[len(b"data: "):]
+                    if payload.strip() == b"[DONE]":
+                        break
+                    choices = _json_loads(payload).get("choices") or [{}]
+                    content = choices[0].get("delta", {}).get("content")
+                    if content:
+                        yield content
+        except Exception as e:
+            raise RuntimeError(f"Error calling OpenAI-compatible API: {e}")
+
+
+class CachedLLMProvider(LLMProvider):
+    """
+    Wraps another provider and reuses responses for identical requests
+    Useful for test scripts that replay the same prompts across runs
+    """
+
+    def __init__(self, provider: LLMProvider, cache_path: Optional[str] = None):
+        """
+        Args:
+            provider: Provider used on cache misses
+            cache_path: Optional shelve file to persist the cache across runs
+        """
+        self.provider = provider
+        self.cache_path = cache_path
+        self._cache: Dict[str, str] = {}
+        # Serializes writes to the shelve file (batch and test threads share the cache)
+        self._lock = threading.Lock()
+        if cache_path:
+            with shelve.open(cache_path) as db:
+                self._cache.update(db)
+
+    @property
+    def context_window(self) -> Optional[int]:
+        return self.provider.context_window
+
+    @staticmethod
+    def _cache_key(messages: List[Dict[str, str]], max_tokens: int, temperature: float) -> str:
+        payload = {"messages": messages, "max_tokens": max_tokens, "temperature": temperature}
+        if orjson is not None:
+            data = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+        else:
+            data = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def generate(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> str:
+        """Return the cached response, or generate and cache it"""
+        key = self._cache_key(messages, max_tokens, temperature)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        response = self.provider.generate(messages, max_tokens=max_tokens, temperature=temperature)
+        self._store(key, response)
+        return response
+
+    def generate_stream(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> Iterator[str]:
+        """Replay the cached response, or stream and cache it"""
+        key = self._cache_key(messages, max_tokens, temperature)
+        cached = self._cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        chunks = []
+        for chunk in self.provider.generate_stream(messages, max_tokens=max_tokens, temperature=temperature):
+            chunks.append(chunk)
+            yield chunk
+        self._store(key, "".join(chunks))
+
+    def batch_generate(self, batch: List[List[Dict[str, str]]], max_tokens: int = 512,
+                       temperature: float = 0.7, max_workers: int = 8) -> List[str]:
+        """
+        Answer the cached requests, and send the misses as one batch to the
+        wrapped provider (which decides how to run them, e.g. sequentially
+        for a local model)
+        """
+        responses: List[Optional[str]] = []
+        # Cache key -> positions in the batch, for the requests not in the cache
+        misses: Dict[str, List[int]] = {}
+        miss_requests = []
+        for i, messages in enumerate(batch):
+            key = self._cache_key(messages, max_tokens, temperature)
+            cached = self._cache.get(key)
+            responses.append(cached)
+            if cached is None:
+                if key not in misses:
+                    misses[key] = []
+                    miss_requests.append(messages)
+                misses[key].append(i)
+
+        if miss_requests:
+            generated = self.provider.batch_generate(
+                miss_requests, max_tokens=max_tokens, temperature=temperature, max_workers=max_workers
+            )
+            for (key, positions), response in zip(misses.items(), generated):
+                self._store(key, response)
+                for i in positions:
+                    responses[i] = response
+        return responses
+
+    def _store(self, key: str, response: str):
+        with self._lock:
+            self._cache[key] = response
+            if self.cache_path:
+                with shelve.open(self.cache_path) as db:
+                    db[key] = response
+
 
-def create_llm_provider(provider_type: str = "ollama", **kwargs) -> LLMProvider:
+def create_llm_provider(provider_type: str = "ollama", cache: bool = False,
+                        cache_path: Optional[str] = None, **kwargs) -> LLMProvider:
     """
     Factory function to create LLM provider
 
     Args:
         provider_type: One of "ollama", "huggingface", "openai_compatible"
+        cache: Wrap the provider in a CachedLLMProvider
+        cache_path: Persist the response cache to this shelve file (implies cache)
         **kwargs: Provider-specific arguments
 
     Returns:
@@ -155,4 +384,7 @@ def create_llm_provider(provider_type: str = "ollama", **kwargs) -> LLMProvider:
     if provider_type not in providers:
         raise ValueError(f"Unknown provider type: {provider_type}. Choose from {list(providers.keys())}")
 
-    return providers[provider_type](**kwargs)
+    provider = providers[provider_type](**kwargs)
+    if cache or cache_path:
+        provider = CachedLLMProvider(provider, cache_path=cache_path)
+    return provider
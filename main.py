@@ -2,6 +2,7 @@
 Main application for the Virtual Waiter Agent
 """
 import json
+import logging
 import sys
 from pathlib import Path
 from typing import Optional
@@ -102,8 +103,9 @@ def run_interactive_mode(agent: WaiterAgent, menu: dict):
     """Run interactive conversation mode"""
     print_welcome()
 
-    # Initial greeting from the waiter
-    initial_greeting = agent.chat("Ciao!")
+    # Initial greeting from the waiter, generated by the LLM as the system
+    # prompt asks (not the canned fast-path reply)
+    initial_greeting = agent.chat("Ciao!", fastpath=False)
     print(f"\n🧑‍🍳 Cameriere: {initial_greeting}\n")
 
     while True:
@@ -177,9 +179,18 @@ def main():
         type=str,
         help="Base URL for API providers"
     )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="Show how orders are extracted from the conversation"
+    )
 
     args = parser.parse_args()
 
+    if args.debug:
+        logging.basicConfig(format="%(message)s")
+        logging.getLogger("waiter_agent").setLevel(logging.DEBUG)
+
     # Load menu
     print("📂 Caricamento menu...")
     menu = load_menu(args.menu)
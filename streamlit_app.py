@@ -3,6 +3,7 @@ Streamlit Web Interface for Virtual Waiter Agent
 A beautiful and interactive chat interface for ordering food
 """
 import json
+import pandas as pd
 import streamlit as st
 from pathlib import Path
 import sys
@@ -186,23 +187,49 @@ def display_order_summary(agent: WaiterAgent):
     if order.items or order.special_requests:
         st.markdown('<div class="order-summary"><h4>📝 Il Tuo Ordine</h4></div>', unsafe_allow_html=True)
         
-        # Display each item with remove button
-        for idx, order_item in enumerate(order.items):
-            item = order_item["item"]
-            qty = order_item["quantity"]
-            col1, col2 = st.columns([4, 1])
-            
-            with col1:
-                item_text = f"{item['nome']} x{qty} (€{item['prezzo'] * qty:.2f})"
-                if item.get('custom'):
-                    item_text += " ⚠️"
-                st.write(item_text)
-            
-            with col2:
-                if st.button("❌", key=f"remove_{idx}_{item.get('id', item['nome'])}"):
-                    item_id = item.get('id', item['nome'])
-                    agent.order.remove_item(item_id)
-                    st.rerun()
+        # Display items in a single editor: deleted rows are applied in batch
+        # when the form is submitted (one rerun instead of one per item)
+        item_ids = [order_item.item.get('id', order_item.item['nome']) for order_item in order.items]
+        df = pd.DataFrame([
+            {
+                "Piatto": order_item.item['nome'] + (" ⚠️" if order_item.item.get('custom') else ""),
+                "Quantità": order_item.quantity,
+                "Prezzo": order_item.item['prezzo'] * order_item.quantity,
+            }
+            for order_item in order.items
+        ], columns=["Piatto", "Quantità", "Prezzo"])
+
+        # The version changes after each batch removal so that stale
+        # deleted_rows indices are not re-applied to the new order
+        editor_key = f"order_editor_{st.session_state.get('order_editor_version', 0)}"
+        with st.form("order_form"):
+            # num_rows="dynamic" is needed to delete rows, but it also shows
+            # the add-row control: added rows are ignored (items are only
+            # added through the conversation), since streamlit>=1.50 has no
+            # delete-only mode
+            st.data_editor(
+                df,
+                num_rows="dynamic",
+                key=editor_key,
+                hide_index=True,
+                width="stretch",
+                disabled=["Piatto", "Quantità", "Prezzo"],
+                column_config={
+                    "Piatto": st.column_config.TextColumn("Piatto"),
+                    "Quantità": st.column_config.NumberColumn("Qtà", format="x%d"),
+                    "Prezzo": st.column_config.NumberColumn("Prezzo", format="€%.2f"),
+                }
+            )
+            remove_submitted = st.form_submit_button("🗑️ Rimuovi selezionati")
+
+        if remove_submitted:
+            deleted_rows = st.session_state[editor_key].get("deleted_rows", [])
+            for row in sorted(set(deleted_rows)):
+                if row < len(item_ids):
+                    agent.order.remove_item(item_ids[row])
+            if deleted_rows:
+                st.session_state.order_editor_version = st.session_state.get('order_editor_version', 0) + 1
+                st.rerun()
         
         # Display total
         st.markdown(f"**Totale: €{order.total:.2f}**")
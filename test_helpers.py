@@ -0,0 +1,40 @@
+"""
+Funzioni condivise dagli script di test
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from waiter_agent import WaiterAgent
+
+# Cases are independent and I/O-bound on the LLM, so run them concurrently
+MAX_WORKERS = 6
+
+
+@lru_cache(maxsize=4)
+def load_menu(menu_path: str = "menu.json") -> dict:
+    """Load menu from JSON file (parsed once per path and shared, do not modify)"""
+    with open(menu_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def show_extraction_log():
+    """Print the order extraction details of the agent (its DEBUG log) on the console"""
+    logging.basicConfig(format="%(message)s")
+    logging.getLogger("waiter_agent").setLevel(logging.DEBUG)
+
+
+def _run_dialog(base_agent: WaiterAgent, dialog: List[str]) -> Tuple[WaiterAgent, Optional[str]]:
+    """Run one dialog on a fresh agent, so cases share no order or history"""
+    agent = base_agent.clone()
+    last_response = None
+    for msg in dialog:
+        last_response = agent.chat(msg)
+    return agent, last_response
+
+
+def run_dialogs(base_agent: WaiterAgent, dialogs: List[List[str]]) -> List[Tuple[WaiterAgent, Optional[str]]]:
+    """Run the dialogs concurrently; (agent, last response) of each, in order"""
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(lambda dialog: _run_dialog(base_agent, dialog), dialogs))
@@ -1,14 +1,9 @@
 """
 Test per verificare che le domande informative non aggiungano item all'ordine
 """
-import json
 from llm_provider import create_llm_provider
 from waiter_agent import WaiterAgent
-
-
-def load_menu(menu_path: str = "menu.json") -> dict:
-    with open(menu_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+from test_helpers import load_menu, run_dialogs, show_extraction_log
 
 
 def test_info_questions():
@@ -19,8 +14,8 @@ def test_info_questions():
     
     menu = load_menu("menu.json")
     llm_provider = create_llm_provider("ollama", model_name="llama3.2:1b")
-    agent = WaiterAgent(menu, llm_provider)
-    
+    base_agent = WaiterAgent(menu, llm_provider)
+
     test_cases = [
         {
             "input": "Ciao vedo che nel menu c'è una voce chiamata 'pane, vino e zucchero' che significa?",
@@ -56,20 +51,17 @@ def test_info_questions():
     
     passed = 0
     failed = 0
-    
-    for i, test in enumerate(test_cases, 1):
+
+    agents = [agent for agent, _ in run_dialogs(base_agent, [[test['input']] for test in test_cases])]
+
+    for i, (test, agent) in enumerate(zip(test_cases, agents), 1):
         print(f"\n{'='*60}")
         print(f"Test {i}/{len(test_cases)}")
         print(f"Input: '{test['input']}'")
         print(f"Atteso: {test['expected']}")
         
-        initial_count = len(agent.get_order().items)
-        
-        # Send message
-        response = agent.chat(test['input'])
-        
         final_count = len(agent.get_order().items)
-        added = final_count > initial_count
+        added = final_count > 0
         
         # Check result
         success = (added == test['should_add'])
@@ -90,14 +82,16 @@ def test_info_questions():
     print(f"❌ Falliti: {failed}/{len(test_cases)}")
     print(f"{'='*60}\n")
     
-    # Show final order
-    order = agent.get_order()
-    if order.items:
-        print("📝 Ordine finale:")
-        print(order.get_summary())
+    # Show orders of the cases that added items
+    added_orders = [agent.get_order() for agent in agents if agent.get_order().items]
+    if added_orders:
+        print("📝 Ordini dei casi con item aggiunti:")
+        for order in added_orders:
+            print(order.get_summary())
     else:
         print("📝 Nessun item nell'ordine")
 
 
 if __name__ == "__main__":
+    show_extraction_log()
     test_info_questions()
@@ -1,15 +1,9 @@
 """
 Test script per il cameriere virtuale con il nuovo menu
 """
-import json
 from llm_provider import create_llm_provider
 from waiter_agent import WaiterAgent
-
-
-def load_menu(menu_path: str = "menu.json") -> dict:
-    """Load menu from JSON file"""
-    with open(menu_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+from test_helpers import load_menu, show_extraction_log
 
 
 def test_conversation():
@@ -88,4 +82,5 @@ def test_conversation():
 
 
 if __name__ == "__main__":
+    show_extraction_log()
     test_conversation()
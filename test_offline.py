@@ -0,0 +1,302 @@
+"""
+Test di regressione offline (senza LLM): matcher delle frasi, estrazione dell'ordine
+su entrambi i formati di menu e filtri di search_menu
+"""
+import copy
+import random
+from typing import Dict, List
+from llm_provider import LLMProvider
+from waiter_agent import (WaiterAgent, Order, _PhraseMatcher, _INTENT_MATCHER, _fold, _ORDER_PHRASES,
+                          _NON_ORDER_PHRASES, _CONFERMA_PHRASES, _ACQUA_PHRASES, _PRONOUN_PHRASES,
+                          _SUMMARY_PROMPT, PROMPT_TOKEN_BUDGET)
+from test_helpers import load_menu
+
+
+class FakeLLMProvider(LLMProvider):
+    """Provider that returns a fixed response and records the requests"""
+
+    def __init__(self, response: str = "Certo!"):
+        self.response = response
+        self.requests: List[List[Dict[str, str]]] = []
+
+    def generate(self, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.7) -> str:
+        self.requests.append(messages)
+        return self.response
+
+
+def _report(name: str, failures: list):
+    """Print the failures of a test, then fail it if there are any"""
+    if failures:
+        print(f"❌ {name}: {len(failures)} casi falliti")
+        for failure in failures[:5]:
+            print(f"   {failure}")
+    else:
+        print(f"✅ {name}")
+    assert not failures, failures[:5]
+
+
+def test_phrase_matcher():
+    """_PhraseMatcher.find must report the same tags as naive substring checks"""
+    failures = []
+    rnd = random.Random(0)
+
+    # Small alphabet: many overlapping phrases and phrases that are prefixes of others
+    for _ in range(300):
+        phrases = [("".join(rnd.choice("ab ") for _ in range(rnd.randint(1, 5))), tag) for tag in range(8)]
+        matcher = _PhraseMatcher(phrases)
+        for _ in range(20):
+            text = "".join(rnd.choice("ab c") for _ in range(rnd.randint(0, 30)))
+            expected = {tag for phrase, tag in phrases if phrase and phrase in text}
+            found = matcher.find(text)
+            if found != expected:
+                failures.append((phrases, text, found, expected))
+
+    # Menu names, on messages that mention some of them
+    for menu_path in ("menu.json", "default_menu.json"):
+        index = WaiterAgent(load_menu(menu_path), FakeLLMProvider())._index
+        for _ in range(300):
+            text = " e ".join(rnd.sample(index.names_lower, 3))
+            expected = {idx for idx, name in enumerate(index.names_lower) if name in text}
+            found = index.name_matcher.find(text)
+            if found != expected:
+                failures.append((menu_path, text, found, expected))
+
+    # Intent keywords, against the phrase sets they are built from
+    intents = {"order": _ORDER_PHRASES, "non_order": _NON_ORDER_PHRASES, "conferma": _CONFERMA_PHRASES,
+               "acqua": _ACQUA_PHRASES, "pronoun": _PRONOUN_PHRASES}
+    for message in ("Ok, va bene, lo prendo", "Cos'è il Pain Perdu?", "Vorrei dell'acqua frizzante",
+                    "Mi puoi dire cosa contiene?", "Aggiungili all'ordine", "per me un cappuccino",
+                    "Quanto costa il caffè?", "Perfetto, lo prendo senza zucchero"):
+        message_lower = _fold(message)
+        expected = {intent for intent, phrases in intents.items()
+                    if any(_fold(phrase) in message_lower for phrase in phrases)}
+        found = _INTENT_MATCHER.find(message_lower)
+        if found != expected:
+            failures.append((message, found, expected))
+
+    _report("Matcher delle frasi", failures)
+
+
+# (menu, messaggio, ultima risposta del cameriere, piatti attesi)
+EXTRACTION_CASES = [
+    ("menu.json", "Cos'è il Pain Perdu?", "", []),
+    ("menu.json", "Quanto costa il cappuccino?", "", []),
+    ("menu.json", "Prendo un cappuccino", "", ["Cappuccino"]),
+    ("menu.json", "Vorrei un Caffe Latte", "", ["Caffè Latte"]),
+    ("menu.json", "Prendo il pain perdu e un cappuccino", "", ["Pain Perdu", "Cappuccino"]),
+    ("menu.json", "Ok, va bene!", "Le consiglio il Cappuccino e il Pain Perdu.", ["Pain Perdu", "Cappuccino"]),
+    ("menu.json", "Lo prendo", "Le consiglio il Pain Perdu, è ottimo.", ["Pain Perdu"]),
+    ("menu.json", "Vorrei dell'acqua", "", ["Acqua"]),
+    ("menu.json", "Perfetto", "Le propongo un calice di rosé.", ["Vino Rosé"]),
+    ("default_menu.json", "Cosa significa caprese?", "", []),
+    ("default_menu.json", "Vorrei gli spaghetti alla carbonara e il tiramisu", "",
+     ["Spaghetti alla Carbonara", "Tiramisù"]),
+    ("default_menu.json", "Va bene, aggiungili", "Le suggerisco la Bruschetta Classica e un Limoncello.",
+     ["Bruschetta Classica", "Limoncello"]),
+    ("default_menu.json", "La prendo", "Le consiglio la Panna Cotta.", ["Panna Cotta"]),
+]
+
+
+def test_order_extraction():
+    """_extract_order_with_llm on both menu formats, and the order updated by chat()"""
+    failures = []
+    for menu_path, message, response, expected in EXTRACTION_CASES:
+        agent = WaiterAgent(load_menu(menu_path), FakeLLMProvider(response))
+        found = [item["nome"] for item in agent._extract_order_with_llm(message, response)]
+        if found != expected:
+            failures.append((menu_path, message, found, expected))
+
+        # Same turn through chat() and chat_stream(), with the fake LLM giving the response
+        for stream in (False, True):
+            chat_agent = agent.clone()
+            if stream:
+                "".join(chat_agent.chat_stream(message))
+            else:
+                chat_agent.chat(message)
+            ordered = [line.item["nome"] for line in chat_agent.get_order().items]
+            if sorted(ordered) != sorted(expected):
+                failures.append((menu_path, message, "chat_stream" if stream else "chat", ordered, expected))
+
+    _report("Estrazione ordine", failures)
+
+
+def _naive_search(menu: dict, query: str, filters: dict) -> list:
+    """Reference search_menu: a plain scan over the menu, as originally written"""
+    sections = menu.get("sezioni", [])
+    if sections:
+        items = [(sezione["nome"], item) for sezione in sections for item in sezione.get("voci", [])]
+    else:
+        items = [(categoria, item) for categoria, voci in menu.get("categorie", {}).items() for item in voci]
+
+    results = []
+    query_lower = query.lower()
+    for categoria, item in items:
+        if filters.get("vegetarian") and not item.get("vegetariano"):
+            continue
+        if filters.get("max_price"):
+            prezzo = min(t["prezzo"] for t in item["taglie"]) if item.get("taglie") else item.get("prezzo", 0)
+            # Items without a price (e.g. "Ostriche", prezzo di mercato) are not within any budget
+            if prezzo is None or prezzo > filters["max_price"]:
+                continue
+        if filters.get("category") and categoria != filters["category"]:
+            continue
+        if any(allergen in item.get("allergeni", []) for allergen in filters.get("exclude_allergens") or []):
+            continue
+        if query_lower and not (query_lower in item["nome"].lower() or
+                                query_lower in item.get("descrizione", "").lower()):
+            continue
+        results.append({**item, "categoria": categoria})
+    return results
+
+
+def test_search_menu():
+    """search_menu (query, filters, limit) against a plain scan of the menu"""
+    failures = []
+    rnd = random.Random(1)
+    for menu_path in ("menu.json", "default_menu.json"):
+        menu = load_menu(menu_path)
+        agent = WaiterAgent(menu, FakeLLMProvider())
+        items = [item for _, item in agent._index.menu_items]
+        categories = sorted({categoria for categoria, _ in agent._index.menu_items})
+        allergens = sorted({a for item in items for a in item.get("allergeni", [])}, key=str)
+
+        queries = ["", "e", "tè", "caffè", "CAFFÈ", "pane", "te", "pasta", "xyz"]
+        queries += [rnd.choice(items)["nome"][rnd.randint(0, 3):][:rnd.randint(1, 10)] for _ in range(40)]
+        for query in queries:
+            filters = {}
+            if rnd.random() < 0.3:
+                filters["vegetarian"] = True
+            if rnd.random() < 0.3:
+                filters["max_price"] = rnd.choice([3, 6, 10, 20])
+            if rnd.random() < 0.3:
+                filters["category"] = rnd.choice(categories)
+            if allergens and rnd.random() < 0.3:
+                filters["exclude_allergens"] = rnd.sample(allergens, min(2, len(allergens)))
+
+            expected = _naive_search(menu, query, filters)
+            found = agent.search_menu(query, filters)
+            if found != expected:
+                failures.append((menu_path, query, filters, len(found), len(expected)))
+            if agent.search_menu(query, filters, limit=2) != expected[:2]:
+                failures.append((menu_path, query, filters, "limit"))
+            if list(agent.iter_search_menu(query, filters)) != expected:
+                failures.append((menu_path, query, filters, "iter"))
+
+    _report("Ricerca nel menu", failures)
+
+
+def test_search_results_are_copies():
+    """Modifying a search result must not leak into the results of other agents"""
+    failures = []
+    menu = load_menu("default_menu.json")
+    agent_a = WaiterAgent(copy.deepcopy(menu), FakeLLMProvider())
+    agent_b = WaiterAgent(copy.deepcopy(menu), FakeLLMProvider())
+    expected = agent_b.search_menu("carbonara")[0]["prezzo"]
+
+    agent_a.search_menu("carbonara")[0]["prezzo"] = 0
+    agent_a.search_menu("carbonara", limit=1)[0]["prezzo"] = 0
+    next(agent_a.iter_search_menu("carbonara"))["prezzo"] = 0
+    for found in (agent_b.search_menu("carbonara"), agent_b.search_menu("carbonara", limit=1),
+                  list(agent_b.iter_search_menu("carbonara"))):
+        if found[0]["prezzo"] != expected:
+            failures.append((found[0]["nome"], found[0]["prezzo"], expected))
+
+    _report("Risultati della ricerca indipendenti", failures)
+
+
+def test_unpriced_items():
+    """Items without a price ("Ostriche") are left out of budget searches and orders"""
+    failures = []
+    agent = WaiterAgent(load_menu("menu.json"), FakeLLMProvider())
+    if any(item["nome"] == "Ostriche" for item in agent.search_menu("", {"max_price": 10})):
+        failures.append("Ostriche entro il budget")
+    if [item["nome"] for item in agent.search_menu("ostriche")][:1] != ["Ostriche"]:
+        failures.append("Ostriche non trovate senza filtri")
+
+    agent.chat("Prendo le ostriche")
+    if agent.get_order().items:
+        failures.append(("ordine", agent.get_order().items))
+    try:
+        Order().add_item({"nome": "Ostriche", "prezzo": None})
+        failures.append("add_item ha accettato una voce senza prezzo")
+    except ValueError:
+        pass
+
+    _report("Voci senza prezzo", failures)
+
+
+def test_prompt_token_budget():
+    """The history sent to the LLM is cut to the provider's context window"""
+    failures = []
+    llm = FakeLLMProvider()
+    llm.context_window = 1500
+    agent = WaiterAgent(load_menu("default_menu.json"), llm, enable_fastpath=False)
+    for turn in range(3):
+        agent.chat(f"domanda {turn} " + "parola " * 100)
+
+    sent = [request for request in llm.requests if request[0]["content"] != _SUMMARY_PROMPT][-1]
+    if len(sent) >= 2 + len(agent.conversation_history):
+        failures.append(("storia non tagliata", len(sent), len(agent.conversation_history)))
+    if WaiterAgent(load_menu("default_menu.json"), FakeLLMProvider()).prompt_token_budget != PROMPT_TOKEN_BUDGET:
+        failures.append("budget di default")
+    if WaiterAgent(load_menu("default_menu.json"), llm, prompt_token_budget=4096).prompt_token_budget != 4096:
+        failures.append("budget esplicito")
+
+    _report("Budget di token del prompt", failures)
+
+
+def test_fastpath_override():
+    """chat(..., fastpath=False) asks the LLM for this message only"""
+    failures = []
+    llm = FakeLLMProvider("Benvenuti al MAMA!")
+    agent = WaiterAgent(load_menu("default_menu.json"), llm)
+    if agent.chat("Ciao!", fastpath=False) != "Benvenuti al MAMA!":
+        failures.append("saluto non generato dall'LLM")
+    if agent.chat("Ciao!") == "Benvenuti al MAMA!" or len(llm.requests) != 1:
+        failures.append("risposta rapida non ripristinata")
+    if not agent.enable_fastpath:
+        failures.append("enable_fastpath modificato")
+
+    _report("Risposte rapide per messaggio", failures)
+
+
+def test_history_compaction():
+    """Messages pushed back by fast-path turns are summarized, never dropped"""
+    failures = []
+    llm = FakeLLMProvider()
+    agent = WaiterAgent(load_menu("default_menu.json"), llm)
+    # 4 LLM turns (8 messages: not compacted yet), then 3 fast-path turns
+    for turn in range(4):
+        agent.chat(f"domanda {turn}")
+    for _ in range(3):
+        agent.chat("Grazie")
+    agent.chat("un'altra domanda")
+
+    summaries = [request for request in llm.requests if request[0]["content"] == _SUMMARY_PROMPT]
+    if len(summaries) != 1:
+        failures.append(("richieste di riassunto", len(summaries)))
+    else:
+        summarized = summaries[0][1]["content"]
+        for turn in range(4):
+            if f"domanda {turn}" not in summarized:
+                failures.append(("messaggio non riassunto", f"domanda {turn}"))
+    if len(agent.get_conversation_history()) != 16:
+        failures.append(("trascrizione", len(agent.get_conversation_history())))
+
+    _report("Riassunto della conversazione", failures)
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("🧪 TEST DI REGRESSIONE OFFLINE")
+    print("=" * 60)
+    failed = 0
+    for test in (test_phrase_matcher, test_order_extraction, test_search_menu,
+                 test_search_results_are_copies, test_unpriced_items,
+                 test_prompt_token_budget, test_fastpath_override,
+                 test_history_compaction):
+        try:
+            test()
+        except AssertionError:
+            failed += 1
+    print(f"\n{'✅ Tutti i test passati' if not failed else f'❌ {failed} test falliti'}")
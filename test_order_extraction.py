@@ -1,15 +1,9 @@
 """
 Test per verificare l'extraction automatica degli ordini
 """
-import json
 from llm_provider import create_llm_provider
 from waiter_agent import WaiterAgent
-
-
-def load_menu(menu_path: str = "menu.json") -> dict:
-    """Load menu from JSON file"""
-    with open(menu_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+from test_helpers import load_menu, show_extraction_log
 
 
 def test_order_extraction():
@@ -70,7 +64,7 @@ def test_order_extraction():
         print(f"📝 Ordine attuale: {len(order.items)} items")
         if order.items:
             for item in order.items:
-                print(f"   - {item['item']['nome']}: €{item['item'].get('prezzo', 0):.2f}")
+                print(f"   - {item.item['nome']}: €{item.item.get('prezzo', 0):.2f}")
         
         print("\n" + "-" * 60 + "\n")
     
@@ -88,4 +82,5 @@ def test_order_extraction():
 
 
 if __name__ == "__main__":
+    show_extraction_log()
     test_order_extraction()
@@ -1,19 +1,15 @@
 """
 Test avanzati per l'estrazione automatica dell'ordine in casi di dialogo naturale e conferme implicite.
 """
-import json
 import os
 from dotenv import load_dotenv
 from llm_provider import create_llm_provider
 from waiter_agent import WaiterAgent
+from test_helpers import load_menu, run_dialogs, show_extraction_log
 
 # Load environment variables
 load_dotenv()
 
-def load_menu(menu_path: str = "menu.json") -> dict:
-    with open(menu_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
 def test_hard_cases():
     print("=" * 60)
     print("🧪 TEST AVANZATI ESTRAZIONE ORDINE")
@@ -24,7 +20,7 @@ def test_hard_cases():
         model_name="gpt-4o",
         api_key=os.getenv("OPENAI_API_KEY")
     )
-    agent = WaiterAgent(menu, llm_provider)
+    base_agent = WaiterAgent(menu, llm_provider)
 
     cases = [
         {
@@ -68,15 +64,12 @@ def test_hard_cases():
         }
     ]
 
-    for i, case in enumerate(cases, 1):
+    results = run_dialogs(base_agent, [case["dialog"] for case in cases])
+
+    for i, (case, (agent, last_response)) in enumerate(zip(cases, results), 1):
+        order_items = [item.item["nome"] for item in agent.get_order().items]
         print(f"\n{'='*60}")
         print(f"Test {i}: {case['desc']}")
-        agent.reset_order()
-        last_response = None
-        for msg in case["dialog"]:
-            last_response = agent.chat(msg)
-        
-        order_items = [item["item"]["nome"] for item in agent.get_order().items]
         print(f"Ordine estratto: {order_items}")
         
         # Check expectations
@@ -95,4 +88,5 @@ def test_hard_cases():
             print(f"Ultima risposta: {last_response[:200]}...")
 
 if __name__ == "__main__":
+    show_extraction_log()
     test_hard_cases()
@@ -1,91 +1,577 @@
 """
 Waiter Agent - Intelligent conversational agent for restaurant ordering
 """
+import copy
+import hashlib
 import json
-from typing import List, Dict, Optional, Any
+import logging
+import re
+import sys
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from typing import List, Dict, Optional, Any, Iterable, Iterator, Tuple, Set, Deque, NamedTuple
 from dataclasses import dataclass, field
-from enum import Enum
 from llm_provider import LLMProvider
 
+try:
+    # Optional: faster menu serialization for the prompt cache key
+    import orjson
+except ImportError:
+    orjson = None
 
-class ConversationPhase(Enum):
-    """Phases of the conversation"""
-    GREETING = "greeting"
-    TAKING_ORDER = "taking_order"
-    SUGGESTIONS = "suggestions"
-    CONFIRMING = "confirming"
-    COMPLETED = "completed"
+# Order extraction details (which items were matched and why), at DEBUG level
+logger = logging.getLogger(__name__)
 
 
-@dataclass
+class ConversationPhase:
+    """Phases of the conversation (plain int constants)"""
+    GREETING = 0
+    TAKING_ORDER = 1
+    SUGGESTIONS = 2
+    CONFIRMING = 3
+    COMPLETED = 4
+
+
+def _order_item_id(item: Dict[str, Any]) -> Any:
+    """ID of an ordered item (its name when the menu item has no id)"""
+    return item.get("id", item["nome"])
+
+
+class OrderLine(NamedTuple):
+    """A line of the order: menu item and quantity"""
+    item: Dict[str, Any]
+    quantity: int
+
+
+@dataclass(slots=True)
 class Order:
     """Represents a customer order"""
-    items: List[Dict[str, Any]] = field(default_factory=list)
-    total: float = 0.0
+    items: List[OrderLine] = field(default_factory=list)
     special_requests: List[str] = field(default_factory=list)
+    # IDs of the ordered items, for O(1) duplicate checks
+    _item_ids: Set[Any] = field(default_factory=set, repr=False)
+    # Folded names of the ordered items, to skip what was already ordered
+    _names_lower: Set[str] = field(default_factory=set, repr=False)
+    # Running total in integer cents, so adds/removes never drift
+    _total_cents: int = field(default=0, repr=False)
+    # Item lines + total of get_summary, rebuilt only after the order changes
+    _summary: Optional[str] = field(default=None, repr=False, compare=False)
+
+    @property
+    def total(self) -> float:
+        """Order total in euros"""
+        return self._total_cents / 100
 
     def add_item(self, item: Dict[str, Any], quantity: int = 1):
         """Add item to order"""
-        self.items.append({
-            "item": item,
-            "quantity": quantity
-        })
-        self.total += item["prezzo"] * quantity
+        if item.get("prezzo") is None:
+            raise ValueError(f"Item without a price can't be ordered: {item.get('nome')}")
+        self.items.append(OrderLine(item, quantity))
+        self._item_ids.add(_order_item_id(item))
+        self._names_lower.add(sys.intern(_fold(item["nome"])))
+        self._total_cents += round(item["prezzo"] * 100) * quantity
+        self._summary = None
 
     def remove_item(self, item_id: str) -> bool:
         """Remove item from order"""
         for i, order_item in enumerate(self.items):
-            if order_item["item"]["id"] == item_id:
-                self.total -= order_item["item"]["prezzo"] * order_item["quantity"]
+            if _order_item_id(order_item.item) == item_id:
+                self._total_cents -= round(order_item.item["prezzo"] * 100) * order_item.quantity
                 self.items.pop(i)
+                self._summary = None
+                if all(_order_item_id(other.item) != item_id for other in self.items):
+                    self._item_ids.discard(item_id)
+                name_lower = _fold(order_item.item["nome"])
+                if all(_fold(other.item["nome"]) != name_lower for other in self.items):
+                    self._names_lower.discard(name_lower)
                 return True
         return False
 
+    def __contains__(self, item_id: Any) -> bool:
+        """Whether an item with this ID is in the order"""
+        return item_id in self._item_ids
+
+    def has_name(self, name_lower: str) -> bool:
+        """Whether an item with this (folded) name is in the order"""
+        return name_lower in self._names_lower
+
     def get_summary(self) -> str:
         """Get order summary"""
         if not self.items:
             return "Nessun ordine ancora."
 
-        summary = "Il tuo ordine:\n"
-        for order_item in self.items:
-            item = order_item["item"]
-            qty = order_item["quantity"]
-            summary += f"- {item['nome']} x{qty} ({item['prezzo'] * qty:.2f}€)\n"
-
-        summary += f"\nTotale: {self.total:.2f}€"
+        if self._summary is None:
+            parts = ["Il tuo ordine:\n"]
+            parts.extend(f"- {item['nome']} x{qty} ({item['prezzo'] * qty:.2f}€)\n" for item, qty in self.items)
+            parts.append(f"\nTotale: {self.total:.2f}€")
+            self._summary = "".join(parts)
 
+        summary = self._summary
         if self.special_requests:
             summary += f"\nRichieste speciali: {', '.join(self.special_requests)}"
 
         return summary
 
 
-class WaiterAgent:
+# History compaction: past HISTORY_COMPACT_AT messages, the older ones are
+# summarized by the LLM and only the last HISTORY_KEEP_RECENT stay verbatim
+HISTORY_COMPACT_AT = 8
+HISTORY_KEEP_RECENT = 4
+# After a failed summary, LLM turns to wait before trying again
+HISTORY_COMPACT_RETRY_TURNS = 3
+
+_SUMMARY_PROMPT = """Riassumi in italiano, in poche frasi, questa conversazione tra un cameriere e un cliente.
+Conserva preferenze, allergie, richieste particolari e piatti di cui si è parlato.
+Non elencare l'ordine: è già tracciato a parte."""
+
+# Prompt size budget in tokens (with room left for the response): the
+# provider's context window, or this default when the provider doesn't know it
+PROMPT_TOKEN_BUDGET = 8000
+RESPONSE_TOKEN_RESERVE = 512
+
+
+@lru_cache(maxsize=1)
+def _get_token_encoding():
+    """Load the tiktoken encoding once (None if tiktoken is not installed or unusable)"""
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception:
+        # Not installed, or its BPE file can't be downloaded (offline)
+        return None
+
+
+@lru_cache(maxsize=2048)
+def _count_tokens(text: str) -> int:
+    """Count the tokens of a text (approximated as 4 chars/token without tiktoken)"""
+    encoding = _get_token_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+# Ordering keywords, checked once per message
+_ORDER_KEYWORD_RE = re.compile("prendo|vorrei|voglio|ordino|porto")
+
+# Lowercase + accent folding, so "caffe" matches "caffè" and vice versa
+_FOLD_TABLE = str.maketrans("àáèéìíòóùú", "aaeeiioouu")
+
+
+def _fold(text: str) -> str:
+    """Lowercase text and strip the accents of Italian vowels"""
+    return text.lower().translate(_FOLD_TABLE)
+
+
+# Keyword sets of _extract_order_with_llm (see _INTENT_MATCHER)
+_ORDER_PHRASES = ("prendo", "vorrei", "voglio", "ordino", "porto", "portare", "prendiamo", "per me")
+
+# Strong indicators that it's NOT an order (information requests)
+_NON_ORDER_PHRASES = (
+    "nel menu c'è",
+    "vedo che",
+    "ho visto",
+    "c'è una voce",
+    "che significa",
+    "cosa significa",
+    "cos'è",
+    "che cos'è",
+    "mi spieghi",
+    "puoi spiegarmi",
+    "vorrei sapere",
+    "mi dici",
+    "mi puoi dire",
+    "chiamata",
+    "chiamato"
+)
+
+# Conferme implicite/cumulative dei suggerimenti dell'assistente
+_CONFERMA_PHRASES = (
+    "facciamo", "aggiungi", "aggiungili", "aggiungile", "aggiungilo", "aggiungiamoli",
+    "ok", "va bene", "perfetto", "conferma", "prendiamo anche", "prendiamo sia",
+    "prendiamo tutti", "prendiamo tutto", "va bene sia", "va bene entrambi",
+    "va bene tutti", "prendiamo questi", "prendiamo quelle", "aggiungilo all'ordine",
+    "aggiungili all'ordine", "mettilo nell'ordine", "mettili nell'ordine"
+)
+
+_ACQUA_PHRASES = ("acqua", "bottiglia d'acqua", "bicchiere d'acqua", "acqua naturale", "acqua frizzante")
+
+# Pronoun references (lo/la prendo, questo, quello)
+_PRONOUN_PHRASES = ("lo prendo", "la prendo", "li prendo", "le prendo", "lo voglio", "la voglio",
+                    "questo", "quella", "quello", "questi", "quelli", "perfetto! lo", "ok! lo", "va bene! lo")
+
+# Generic wines named in a response: "vino X", "calice di X", "bottiglia di X"
+# (lookahead, so "calice di vino rosso" yields both "vino" and "rosso")
+_WINE_RE = re.compile(r'(?=vino\s+(\w+)|calice\s+di\s+(\w+)|bottiglia\s+di\s+(\w+))')
+
+def _size_from_message(message_lower: str) -> str:
+    """Size asked for in the message ('piccolo' when not specified)"""
+    if 'grande' in message_lower or 'grosso' in message_lower:
+        return 'grande'
+    return 'piccolo'
+
+
+# Words ignored when matching dish names word by word
+_COMMON_WORDS = frozenset({'di', 'del', 'della', 'il', 'la', 'e', 'con', 'alla', 'al'})
+
+# Trivial messages (greetings, thanks) answered without calling the LLM
+_FASTPATH_REPLIES = {
+    "ciao": "Ciao e benvenuto! Cosa posso portarle oggi?",
+    "buongiorno": "Buongiorno e benvenuto! Cosa posso portarle oggi?",
+    "buonasera": "Buonasera e benvenuto! Cosa posso portarle stasera?",
+    "salve": "Salve e benvenuto! Cosa posso portarle oggi?",
+    "grazie": "Grazie a lei! Se desidera altro, sono qui.",
+}
+
+# Bare requests for the bill, answered with the order summary (matched
+# exactly, like greetings: "quanto fa un cappuccino?" goes to the LLM)
+_BILL_PHRASES = frozenset({"il conto", "quanto fa"})
+
+# Reply given when the LLM request fails
+_ERROR_REPLY = "Mi scuso, ho avuto un problema tecnico. Può ripetere per favore? (Errore: {error})"
+
+
+def _error_reply(error: Exception) -> str:
+    """Apology returned to the customer instead of the failed LLM response"""
+    return _ERROR_REPLY.format(error=error)
+
+
+# Points at which a streamed response is scanned for menu items
+_SENTENCE_END_RE = re.compile(r"[.!?\n]")
+
+
+class _PhraseMatcher:
     """
-    Intelligent waiter agent that helps customers order from a menu
+    Find which phrases of a fixed vocabulary occur in a text with a single
+    regex pass (stdlib alternative to an Aho-Corasick automaton)
     """
 
-    def __init__(self, menu: Dict[str, Any], llm_provider: LLMProvider):
-        self.menu = menu
-        self.llm = llm_provider
-        self.order = Order()
-        self.conversation_history: List[Dict[str, str]] = []
-        self.phase = ConversationPhase.GREETING
-        self.customer_preferences = {
-            "vegetarian": None,
-            "allergies": [],
-            "budget": None,
-            "spicy_preference": None
+    def __init__(self, phrases: Iterable[Tuple[str, Any]]):
+        tags: Dict[str, Set[Any]] = {}
+        for phrase, tag in phrases:
+            if phrase:
+                tags.setdefault(phrase, set()).add(tag)
+
+        # Longest phrases first; the lookahead lets matches overlap
+        ordered = sorted(tags, key=len, reverse=True)
+        self.max_len = len(ordered[0]) if ordered else 0
+        self._pattern = re.compile(
+            "(?=(" + "|".join(re.escape(p) for p in ordered) + "))"
+        ) if ordered else None
+
+        # At each position only the longest phrase is reported, so every
+        # phrase also carries the tags of the phrases that are its prefixes
+        self._tags = {
+            phrase: frozenset().union(*(tags[other] for other in tags if phrase.startswith(other)))
+            for phrase in tags
         }
 
-        # Initialize system prompt
-        self.system_prompt = self._build_system_prompt()
+    def find(self, text: str, pos: int = 0) -> Set[Any]:
+        """Return the tags of all phrases contained in text (starting from pos)"""
+        found: Set[Any] = set()
+        if self._pattern is not None:
+            for match in self._pattern.finditer(text, pos):
+                found |= self._tags[match.group(1)]
+        return found
+
+
+class _StreamScan:
+    """
+    Folded text and phrase matches of a streamed response, scanned a
+    sentence at a time while the rest is still being generated
+    """
+
+    def __init__(self, matcher: _PhraseMatcher):
+        self._matcher = matcher
+        self._parts: List[str] = []
+        self._text = ""
+        self._scanned = 0
+        self.found: Set[Any] = set()
+
+    def feed(self, chunk: str):
+        self._parts.append(_fold(chunk))
+        if _SENTENCE_END_RE.search(chunk):
+            self._scan()
+
+    def _scan(self):
+        self._text = "".join(self._parts)
+        # Rescan the tail of the previous part, for phrases cut by the chunk boundary
+        start = max(0, self._scanned - self._matcher.max_len + 1)
+        self.found |= self._matcher.find(self._text, start)
+        self._scanned = len(self._text)
+
+    def finish(self) -> Tuple[str, Set[Any]]:
+        """Scan what is left and return the folded text with its matches"""
+        self._scan()
+        return self._text, self.found
+
+
+# Preference keywords, all recognised in a single pass over the message
+_COMMON_ALLERGENS = ("glutine", "lattosio", "uova", "solfiti", "frutta secca")
+_PREFERENCE_MATCHER = _PhraseMatcher([
+    ("vegetariano", "vegetarian"), ("vegetariana", "vegetarian"),
+    ("vegano", "vegetarian"), ("vegana", "vegetarian"),
+    ("allergi", "allergy"),
+    ("piccante", "spicy"),
+    ("non", "negation"), ("senza", "negation"),
+    *((allergen, allergen) for allergen in _COMMON_ALLERGENS),
+])
+
+# Intent keywords of _extract_order_with_llm, tagged by set and all
+# recognised in a single pass over the (folded) message
+_INTENT_MATCHER = _PhraseMatcher(
+    (_fold(phrase), intent)
+    for intent, phrases in (
+        ("order", _ORDER_PHRASES),
+        ("non_order", _NON_ORDER_PHRASES),
+        ("conferma", _CONFERMA_PHRASES),
+        ("acqua", _ACQUA_PHRASES),
+        ("pronoun", _PRONOUN_PHRASES),
+    )
+    for phrase in phrases
+)
 
-    def _build_system_prompt(self) -> str:
-        """Build the system prompt for the LLM"""
-        menu_text = self._format_menu_for_llm()
 
-        return f"""Sei un cameriere esperto e cordiale del ristorante "{self.menu['ristorante']}".
+# search_menu results cached per menu (query and filters)
+SEARCH_CACHE_SIZE = 256
+
+# Rendered system prompts and menu indexes, keyed by menu content digest
+_PROMPT_CACHE_SIZE = 8
+_system_prompt_cache: Dict[bytes, str] = {}
+_menu_index_cache: Dict[bytes, "_MenuIndex"] = {}
+
+
+def _menu_cache_key(menu: Dict[str, Any]) -> bytes:
+    """Digest of the menu content, used as key for the prompt caches"""
+    # No sort_keys: the rendering must keep the original category order
+    if orjson is not None:
+        data = orjson.dumps(menu)
+    else:
+        data = json.dumps(menu, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _cached_for_menu(cache: Dict[bytes, Any], menu_key: bytes, build, menu: Dict[str, Any]) -> Any:
+    """Return the cached rendering/index of a menu, building it on first use"""
+    value = cache.get(menu_key)
+    if value is None:
+        if len(cache) >= _PROMPT_CACHE_SIZE:
+            del cache[next(iter(cache))]
+        value = cache[menu_key] = build(menu)
+    return value
+
+
+def _flatten_menu(menu: Dict[str, Any]) -> Iterator[Tuple[int, str, Dict[str, Any]]]:
+    """(section/category position, section/category name, item) of every menu item"""
+    # Support both old format (categorie) and new format (sezioni)
+    if menu.get("sezioni", []):
+        for idx, sezione in enumerate(menu["sezioni"]):
+            for item in sezione.get('voci', []):
+                yield idx, sezione['nome'], item
+    else:
+        for idx, (categoria, items) in enumerate(menu.get("categorie", {}).items()):
+            for item in items:
+                yield idx, categoria, item
+
+
+class _MenuIndex:
+    """
+    Flattened menu items and the lookup structures built from them
+    (name matcher, folded names, filter columns, order-ready entries).
+    Read-only once built, so it is shared by all agents with the same menu
+    """
+
+    def __init__(self, menu: Dict[str, Any]):
+        # The menu format is detected once here: everything else reads the flat lists
+        self.menu_has_sections = bool(menu.get("sezioni", []))
+        flat = list(_flatten_menu(menu))
+        # Section/category names and folded item names are interned, so the
+        # category filter and the ordered-name checks mostly compare by identity
+        self.menu_items = [(sys.intern(section), item) for _, section, item in flat]
+        # Position of each item's section/category (items are grouped by it)
+        self.section_ids = [section_id for section_id, _, _ in flat]
+        # Folded (lowercase, no accents) names, computed once instead of on every message
+        self.names_lower = [sys.intern(_fold(item["nome"])) for _, item in self.menu_items]
+        # Lowercase text for search_menu: accents are kept, so "tè" doesn't
+        # match inside other words and "caffè" doesn't match "decaffeinato"
+        self.search_names = [item["nome"].lower() for _, item in self.menu_items]
+        self.search_descs = [item.get("descrizione", "").lower() for _, item in self.menu_items]
+        # Trigram -> items whose name or description contains it, so a search
+        # only checks the items that have all the trigrams of the query
+        self.trigrams: Dict[str, Set[int]] = {}
+        for idx, (name_lower, desc_lower) in enumerate(zip(self.search_names, self.search_descs)):
+            for text in (name_lower, desc_lower):
+                for i in range(len(text) - 2):
+                    self.trigrams.setdefault(text[i:i + 3], set()).add(idx)
+        # Words of each name; the ones that are not common words (di, con, ...)
+        # are also stored as a bitmask over a vocabulary of all such words
+        self.name_words = [frozenset(name_lower.split()) for name_lower in self.names_lower]
+        self.word_bits: Dict[str, int] = {}
+        self.meaningful_bits = []
+        for words in self.name_words:
+            bits = 0
+            for word in words - _COMMON_WORDS:
+                bits |= self.word_bits.setdefault(word, 1 << len(self.word_bits))
+            self.meaningful_bits.append(bits)
+        self.name_matcher = _PhraseMatcher(
+            (name_lower, idx) for idx, name_lower in enumerate(self.names_lower)
+        )
+
+        # Filter columns for search_menu, one entry per menu item
+        # (None for items without a price, e.g. "prezzo di mercato")
+        self.prices_min = [
+            min((t['prezzo'] for t in item['taglie'] if t.get('prezzo') is not None), default=None)
+            if item.get('taglie') else item.get('prezzo', 0)
+            for _, item in self.menu_items
+        ]
+        self.is_vegetarian = [bool(item.get("vegetariano")) for _, item in self.menu_items]
+        # search_menu results, with the section/category of each item (copied
+        # by search_menu before they reach the caller)
+        self.search_results = [{**item, "categoria": categoria} for categoria, item in self.menu_items]
+
+        # Order-ready entries for _find_menu_item, built once: one per size for
+        # items with taglie, and the item itself (with an id) otherwise
+        self.index_by_name: Dict[str, int] = {}
+        for idx, name_lower in enumerate(self.names_lower):
+            self.index_by_name.setdefault(name_lower, idx)
+        self.size_variants: List[Optional[List[Tuple[str, Dict[str, Any]]]]] = []
+        self.plain_items: List[Optional[Dict[str, Any]]] = []
+        # Items (and sizes) without a price can't be added to the order
+        for _, item in self.menu_items:
+            priced = item.get('prezzo') is not None
+            if not self.menu_has_sections:
+                self.size_variants.append(None)
+                self.plain_items.append(item if priced else None)
+                continue
+            sizes = [
+                (t['nome'].lower(), {
+                    **item,
+                    'nome': f"{item['nome']} ({t['nome']})",
+                    'prezzo': t['prezzo'],
+                    'id': f"{item['nome']}_{t['nome']}"
+                })
+                for t in item.get('taglie') or () if t.get('prezzo') is not None
+            ]
+            self.size_variants.append(sizes or None)
+            if priced:
+                self.plain_items.append(item if 'id' in item else {**item, 'id': item['nome']})
+            else:
+                self.plain_items.append(None)
+        # Allergens of each item as a bitmask over all the allergens in the menu
+        self.allergen_bits: Dict[Any, int] = {}
+        self.allergens = []
+        for _, item in self.menu_items:
+            bits = 0
+            for allergen in item.get("allergeni", []):
+                bits |= self.allergen_bits.setdefault(allergen, 1 << len(self.allergen_bits))
+            self.allergens.append(bits)
+
+        # Recent searches of this menu (same query and filters), shared by its agents
+        self.search = lru_cache(maxsize=SEARCH_CACHE_SIZE)(self._search)
+
+    def _search(self, *search_args) -> Tuple[Dict[str, Any], ...]:
+        """All the results of iter_search, as a tuple (cached as search)"""
+        return tuple(self.iter_search(*search_args))
+
+    def iter_search(self, query_lower: str, want_vegetarian: Optional[bool], max_price: Optional[float],
+                    category: Optional[str], exclude_allergens: int) -> Iterator[Dict[str, Any]]:
+        """Items matching a lowercase query and the search_menu filters, in menu order"""
+        # Columns bound to locals for the loop
+        menu_items, is_vegetarian, prices_min = self.menu_items, self.is_vegetarian, self.prices_min
+        allergens, names_lower, descs_lower = self.allergens, self.search_names, self.search_descs
+
+        # Single pass over the flattened menu (both formats), restricted
+        # to the items that can match the query
+        for idx in self.search_candidates(query_lower):
+            # Apply filters
+            if want_vegetarian and not is_vegetarian[idx]:
+                continue
+            if max_price and (prices_min[idx] is None or prices_min[idx] > max_price):
+                continue
+            if category and menu_items[idx][0] != category:
+                continue
+            if allergens[idx] & exclude_allergens:
+                continue
+
+            # Search in name and description
+            if query_lower:
+                if not (query_lower in names_lower[idx] or
+                        query_lower in descs_lower[idx]):
+                    continue
+            yield self.search_results[idx]
+
+    def allergen_mask(self, allergens: Iterable[Any]) -> int:
+        """Bitmask of the given allergens (the ones no item has are ignored)"""
+        mask = 0
+        for allergen in allergens:
+            mask |= self.allergen_bits.get(allergen, 0)
+        return mask
+
+    def search_candidates(self, query_lower: str) -> Iterable[int]:
+        """Indices of the items that may contain query_lower (a superset), in menu order"""
+        if len(query_lower) < 3:
+            return range(len(self.menu_items))
+        postings = [self.trigrams.get(query_lower[i:i + 3], set()) for i in range(len(query_lower) - 2)]
+        return sorted(min(postings, key=len).intersection(*postings))
+
+
+def _format_menu(menu: Dict[str, Any]) -> str:
+    """Format menu in a readable way for the LLM"""
+    parts = [f"\nMENU - {menu.get('ristorante', 'Ristorante')}\n"]
+    if 'edizione' in menu:
+        parts.append(f"Edizione: {menu['edizione']}\n")
+
+    # Support both old format (categorie) and new format (sezioni)
+    sections = menu.get("sezioni", [])
+    if sections:
+        # New format with sezioni
+        for sezione in sections:
+            parts.append(f"\n{sezione['nome'].upper()}:\n")
+            for item in sezione.get('voci', []):
+                # Handle items with sizes/taglie
+                if 'taglie' in item:
+                    parts.append(f"- {item['nome']}:\n")
+                    for taglia in item['taglie']:
+                        parts.append(f"  * {taglia['nome']}: €{taglia.get('prezzo', 0):.2f}\n")
+                else:
+                    prezzo = item.get('prezzo')
+                    if prezzo is not None:
+                        parts.append(f"- {item['nome']} (€{prezzo:.2f})")
+                    else:
+                        parts.append(f"- {item['nome']}")
+                    if "descrizione" in item:
+                        parts.append(f": {item['descrizione']}")
+                    if "varianti" in item:
+                        parts.append(f" | Varianti: {', '.join(item['varianti'][:3])}...")
+                    parts.append("\n")
+
+                # Add allergen info
+                if "allergeni" in item and item["allergeni"]:
+                    allergeni_legend = menu.get('allergeni_legend', {})
+                    allergeni_nomi = [allergeni_legend.get(str(a), str(a)) for a in item['allergeni']]
+                    parts.append(f"  Allergeni: {', '.join(allergeni_nomi)}\n")
+    else:
+        # Old format with categorie
+        for categoria, items in menu.get("categorie", {}).items():
+            parts.append(f"\n{categoria.upper()}:\n")
+            for item in items:
+                parts.append(f"- {item['nome']} (€{item.get('prezzo', 0):.2f}): {item.get('descrizione', '')}")
+                if "suggerimenti" in item:
+                    parts.append(f" | Suggerimento: {item['suggerimenti']}")
+                if item.get("vegetariano"):
+                    parts.append(" [VEGETARIANO]")
+                if item.get("vegano"):
+                    parts.append(" [VEGANO]")
+                if "allergeni" in item and item["allergeni"]:
+                    parts.append(f" | Allergeni: {', '.join(item['allergeni'])}")
+                parts.append("\n")
+    return "".join(parts)
+
+
+def _render_system_prompt(menu: Dict[str, Any]) -> str:
+    """Build the system prompt for the LLM"""
+    menu_text = _format_menu(menu)
+
+    return f"""Sei un cameriere esperto e cordiale del ristorante "{menu['ristorante']}".
 Il tuo obiettivo è aiutare il cliente a fare un'ordinazione piacevole e soddisfacente.
 
 PERSONALITÀ:
@@ -120,65 +606,66 @@ FORMATO RISPOSTE:
 
 Inizia salutando il cliente e chiedendo cosa desidera ordinare."""
 
-    def _format_menu_for_llm(self) -> str:
-        """Format menu in a readable way for the LLM"""
-        menu_text = f"\nMENU - {self.menu.get('ristorante', 'Ristorante')}\n"
-        if 'edizione' in self.menu:
-            menu_text += f"Edizione: {self.menu['edizione']}\n"
-        
-        # Support both old format (categorie) and new format (sezioni)
-        sections = self.menu.get("sezioni", [])
-        if sections:
-            # New format with sezioni
-            for sezione in sections:
-                menu_text += f"\n{sezione['nome'].upper()}:\n"
-                for item in sezione.get('voci', []):
-                    # Handle items with sizes/taglie
-                    if 'taglie' in item:
-                        menu_text += f"- {item['nome']}:\n"
-                        for taglia in item['taglie']:
-                            menu_text += f"  * {taglia['nome']}: €{taglia.get('prezzo', 0):.2f}\n"
-                    else:
-                        prezzo = item.get('prezzo')
-                        if prezzo is not None:
-                            menu_text += f"- {item['nome']} (€{prezzo:.2f})"
-                        else:
-                            menu_text += f"- {item['nome']}"
-                        if "descrizione" in item:
-                            menu_text += f": {item['descrizione']}"
-                        if "varianti" in item:
-                            menu_text += f" | Varianti: {', '.join(item['varianti'][:3])}..."
-                        menu_text += "\n"
-                    
-                    # Add allergen info
-                    if "allergeni" in item and item["allergeni"]:
-                        allergeni_legend = self.menu.get('allergeni_legend', {})
-                        allergeni_nomi = [allergeni_legend.get(str(a), str(a)) for a in item['allergeni']]
-                        menu_text += f"  Allergeni: {', '.join(allergeni_nomi)}\n"
-        else:
-            # Old format with categorie
-            for categoria, items in self.menu.get("categorie", {}).items():
-                menu_text += f"\n{categoria.upper()}:\n"
-                for item in items:
-                    menu_text += f"- {item['nome']} (€{item.get('prezzo', 0):.2f}): {item.get('descrizione', '')}"
-                    if "suggerimenti" in item:
-                        menu_text += f" | Suggerimento: {item['suggerimenti']}"
-                    if item.get("vegetariano"):
-                        menu_text += " [VEGETARIANO]"
-                    if item.get("vegano"):
-                        menu_text += " [VEGANO]"
-                    if "allergeni" in item and item["allergeni"]:
-                        menu_text += f" | Allergeni: {', '.join(item['allergeni'])}"
-                    menu_text += "\n"
-        return menu_text
+
+class WaiterAgent:
+    """
+    Intelligent waiter agent that helps customers order from a menu
+    """
+
+    def __init__(self, menu: Dict[str, Any], llm_provider: LLMProvider, enable_fastpath: bool = True,
+                 prompt_token_budget: Optional[int] = None):
+        self.menu = menu
+        self.llm = llm_provider
+        self.enable_fastpath = enable_fastpath
+        # Tokens the prompt and the response must fit in (the model's context window)
+        self.prompt_token_budget = prompt_token_budget or llm_provider.context_window or PROMPT_TOKEN_BUDGET
+        self._reset_session()
+
+        # Lookup structures over the menu items and system prompt,
+        # built once and shared across agents with the same menu
+        self._menu_key = _menu_cache_key(menu)
+        self._index = _cached_for_menu(_menu_index_cache, self._menu_key, _MenuIndex, menu)
+        self.system_prompt = self._build_system_prompt()
+
+    def _reset_session(self):
+        """Initialize the per-customer state (order, history, preferences)"""
+        self.order = Order()
+        # Recent messages sent to the LLM, and the full transcript returned by
+        # get_conversation_history. The recent messages are not bounded: the
+        # older ones leave only through compaction (fast-path turns included),
+        # and _prepare_messages sends just the ones that fit the token budget
+        self.conversation_history: Deque[Dict[str, str]] = deque()
+        self._history_summary = ""
+        self._compact_backoff = 0
+        self._transcript: List[Dict[str, str]] = []
+        self.phase = ConversationPhase.GREETING
+        self.customer_preferences = {
+            "vegetarian": None,
+            "allergies": [],
+            "budget": None,
+            "spicy_preference": None
+        }
+
+    def clone(self) -> "WaiterAgent":
+        """
+        Create an agent for a new customer with the same menu and LLM,
+        reusing the system prompt and menu index instead of rebuilding them
+        """
+        new_agent = copy.copy(self)
+        new_agent._reset_session()
+        return new_agent
+
+    def _build_system_prompt(self) -> str:
+        """Build the system prompt for the LLM"""
+        return _cached_for_menu(_system_prompt_cache, self._menu_key, _render_system_prompt, self.menu)
 
     def _build_context_message(self) -> str:
         """Build context message about current order and preferences"""
-        context = ""
+        parts = []
 
         # Add current order
         if self.order.items:
-            context += f"\nORDINE CORRENTE:\n{self.order.get_summary()}\n"
+            parts.append(f"\nORDINE CORRENTE:\n{self.order.get_summary()}\n")
 
         # Add customer preferences
         prefs = []
@@ -190,255 +677,173 @@ Inizia salutando il cliente e chiedendo cosa desidera ordinare."""
             prefs.append(f"piccante: {self.customer_preferences['spicy_preference']}")
 
         if prefs:
-            context += f"\nPREFERENZE CLIENTE: {' | '.join(prefs)}\n"
+            parts.append(f"\nPREFERENZE CLIENTE: {' | '.join(prefs)}\n")
 
-        return context
+        return "".join(parts)
 
-    def _extract_order_with_llm(self, user_message: str, assistant_response: str) -> List[Dict]:
+    def _extract_order_with_llm(self, user_message: str, assistant_response: str,
+                                message_lower: Optional[str] = None,
+                                response_scan: Optional[Tuple[str, Set[int]]] = None) -> List[Dict]:
         """
         Extract ordered items using keyword matching + fuzzy search
         More reliable than pure LLM extraction with small models
+        response_scan: folded response and the menu items it names, if
+        already computed (e.g. while streaming)
         """
         # Simple but effective: check for ordering keywords
-        message_lower = user_message.lower()
-        
-        # Check if this is an order confirmation
-        order_keywords = ["prendo", "vorrei", "voglio", "ordino", "porto", "portare", "prendiamo", "per me"]
-        question_keywords = ["costa", "prezzo", "cos'è", "cos è", "cosa è", "cosa significa", "che significa", "come", "che tipo", "quale", "mi consigli", "suggerisci", "cosa", "quanto", "che cos'è"]
-        
-        # Strong indicators that it's NOT an order (information requests)
-        non_order_phrases = [
-            "nel menu c'è",
-            "vedo che",
-            "ho visto",
-            "c'è una voce",
-            "che significa",
-            "cosa significa",
-            "cos'è",
-            "che cos'è",
-            "mi spieghi",
-            "puoi spiegarmi",
-            "vorrei sapere",
-            "mi dici",
-            "mi puoi dire",
-            "chiamata",
-            "chiamato"
-        ]
-        
-        # Check for non-order phrases (strong indicators of questions)
-        is_info_request = any(phrase in message_lower for phrase in non_order_phrases)
-        
+        if message_lower is None:
+            message_lower = _fold(user_message)
+
+        intents = _INTENT_MATCHER.find(message_lower)
+
         # If it's clearly an information request, don't extract
-        if is_info_request:
-            print(f"🚫 Rilevata domanda informativa, skip estrazione ordine")
-            print(f"   Frase rilevata: {[p for p in non_order_phrases if p in message_lower]}")
+        if "non_order" in intents:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("🚫 Rilevata domanda informativa, skip estrazione ordine")
+                logger.debug("   Frase rilevata: %s", [p for p in _NON_ORDER_PHRASES if _fold(p) in message_lower])
             return []
-        
+
         # Conferme implicite/cumulative: aggiungi suggerimenti dell'assistente
         # PRIMA di controllare le keyword di ordine esplicito
-        conferma_keywords = [
-            "facciamo", "aggiungi", "aggiungili", "aggiungile", "aggiungilo", "aggiungiamoli", 
-            "ok", "va bene", "perfetto", "conferma", "prendiamo anche", "prendiamo sia", 
-            "prendiamo tutti", "prendiamo tutto", "va bene sia", "va bene entrambi", 
-            "va bene tutti", "prendiamo questi", "prendiamo quelle", "aggiungilo all'ordine",
-            "aggiungili all'ordine", "mettilo nell'ordine", "mettili nell'ordine"
-        ]
-        if any(kw in message_lower for kw in conferma_keywords):
-            # Estrai tutti i piatti/vini suggeriti nell'ultima risposta dell'assistente
-            if assistant_response:
-                response_lower = assistant_response.lower()
-                found_items = []
-                # Get already ordered items to avoid duplicates
-                already_ordered = {order_item["item"]["nome"].lower() for order_item in self.order.items}
-                
-                # Cerca tutti i piatti del menu menzionati nella risposta
-                for sezione in self.menu.get("sezioni", []):
-                    for item in sezione.get('voci', []):
-                        item_name = item["nome"].lower()
-                        # Skip if already in order or already in found_items
-                        if item_name in already_ordered:
-                            continue
-                        if any(f["nome"].lower() == item_name for f in found_items):
-                            continue
-                        # Check if mentioned in response (exact match)
-                        if item_name in response_lower:
-                            found_items.append({"nome": item["nome"], "taglia": None})
-                            continue
-                        
-                        # Fuzzy matching per vini (es. "Vermentino" → "Vermentino di Gallura")
-                        item_words = set(item_name.split())
-                        response_words = set(response_lower.split())
-                        # Se almeno una parola del nome del piatto (escluse parole comuni) è nella risposta
-                        common_words = {'di', 'del', 'della', 'il', 'la', 'e', 'con', 'alla', 'al'}
-                        meaningful_words = item_words - common_words
-                        if meaningful_words and any(word in response_words for word in meaningful_words):
-                            # Verifica che sia plausibile (es. "vino vermentino" → trova "Vermentino di Gallura")
-                            if any(word in response_lower for word in meaningful_words):
-                                found_items.append({"nome": item["nome"], "taglia": None})
-                
-                # Cerca anche nelle categorie vecchie
-                for categoria, items in self.menu.get("categorie", {}).items():
-                    for item in items:
-                        item_name = item["nome"].lower()
-                        # Skip if already in order or already in found_items
-                        if item_name in already_ordered:
-                            continue
-                        if any(f["nome"].lower() == item_name for f in found_items):
-                            continue
-                        # Check if mentioned in response (exact match)
-                        if item_name in response_lower:
-                            found_items.append({"nome": item["nome"], "taglia": None})
-                            continue
-                        
-                        # Fuzzy matching
-                        item_words = set(item_name.split())
-                        response_words = set(response_lower.split())
-                        common_words = {'di', 'del', 'della', 'il', 'la', 'e', 'con', 'alla', 'al'}
-                        meaningful_words = item_words - common_words
-                        if meaningful_words and any(word in response_words for word in meaningful_words):
-                            if any(word in response_lower for word in meaningful_words):
-                                found_items.append({"nome": item["nome"], "taglia": None})
-                
-                if found_items:
-                    print(f"✨ Conferma implicita: aggiungo suggeriti: {[f['nome'] for f in found_items]}")
-                    return found_items
-                
-                # SOLO se non ha trovato nulla nel menu, cerca voci personalizzate (vini generici, bevande)
-                # Pattern per vini generici: "vino [nome]", "calice di [nome]"
-                print("⚠️ Nessun item trovato nel menu, cerco voci personalizzate...")
-                import re
-                custom_items = []
-                wine_patterns = [
-                    r'vino\s+(\w+)',
-                    r'calice\s+di\s+(\w+)',
-                    r'bottiglia\s+di\s+(\w+)',
-                ]
-                for pattern in wine_patterns:
-                    matches = re.findall(pattern, response_lower, re.IGNORECASE)
-                    for wine_name in matches:
-                        wine_name = wine_name.strip().capitalize()
-                        if wine_name and wine_name.lower() not in already_ordered:
-                            # Verifica che non sia già nel menu (controllo doppio)
-                            found_in_menu = False
-                            for sezione in self.menu.get("sezioni", []):
-                                for item in sezione.get('voci', []):
-                                    if wine_name.lower() in item["nome"].lower():
-                                        found_in_menu = True
-                                        break
-                                if found_in_menu:
-                                    break
-                            
-                            if not found_in_menu:
-                                # Crea voce personalizzata per il vino
-                                custom_item = {
-                                    "nome": f"Vino {wine_name}",
-                                    "taglia": None,
-                                    "prezzo": 0.0,  # Prezzo da definire
-                                    "custom": True
-                                }
-                                custom_items.append(custom_item)
-                                print(f"🍷 Creata voce personalizzata: {custom_item['nome']} (prezzo da verificare)")
-                
-                if custom_items:
-                    return custom_items
-        
-        # Skip if it's clearly ONLY a question (no order intent)
-        has_question = any(q in message_lower for q in question_keywords)
-        has_order = any(o in message_lower for o in order_keywords)
-        
-        # If it has question words but no order keywords, skip
-        if has_question and not has_order:
-            return []
-        
+        if "conferma" in intents and assistant_response:
+            if response_scan is None:
+                response_scan = self._scan_response(assistant_response)
+            confirmed_items = self._extract_confirmed_items(assistant_response, *response_scan)
+            if confirmed_items:
+                return confirmed_items
+
         # Only extract if there are explicit ordering keywords
-        if not has_order:
+        # (questions without them are skipped as well)
+        if "order" not in intents:
             return []
 
         # Riconoscimento acqua anche se non è nel menu
-        acqua_keywords = ["acqua", "bottiglia d'acqua", "bicchiere d'acqua", "acqua naturale", "acqua frizzante"]
-        if any(kw in message_lower for kw in acqua_keywords):
-            print("💧 Aggiungo acqua all'ordine (voce gratuita)")
+        if "acqua" in intents:
+            logger.debug("💧 Aggiungo acqua all'ordine (voce gratuita)")
             return [{"nome": "Acqua", "taglia": None, "prezzo": 0.0}]
 
         # Check for pronoun references (lo/la prendo, questo, quello)
         # In this case, look at the assistant's last response for context
-        pronoun_phrases = ["lo prendo", "la prendo", "li prendo", "le prendo", "lo voglio", "la voglio", 
-                          "questo", "quella", "quello", "questi", "quelli", "perfetto! lo", "ok! lo", "va bene! lo"]
-        uses_pronoun = any(phrase in message_lower for phrase in pronoun_phrases)
-        
-        if uses_pronoun and assistant_response:
-            # Extract item names from assistant's response (the item being discussed)
-            response_lower = assistant_response.lower()
-            for sezione in self.menu.get("sezioni", []):
-                for item in sezione.get('voci', []):
-                    item_name_lower = item["nome"].lower()
-                    # Check if the assistant was talking about this item
-                    if item_name_lower in response_lower:
-                        taglia = None
-                        if 'taglie' in item:
-                            if 'grande' in message_lower or 'grosso' in message_lower:
-                                taglia = 'grande'
-                            elif 'piccolo' in message_lower:
-                                taglia = 'piccolo'
-                            else:
-                                taglia = 'piccolo'  # Default
-                        print(f"✨ Riferimento pronominale rilevato: '{item['nome']}' (dal contesto)")
-                        return [{"nome": item["nome"], "taglia": taglia}]
-            
-            # Check old format too
-            for categoria, items in self.menu.get("categorie", {}).items():
-                for item in items:
-                    if item["nome"].lower() in response_lower:
-                        print(f"✨ Riferimento pronominale rilevato: '{item['nome']}' (dal contesto)")
-                        return [{"nome": item["nome"], "taglia": None}]
-        
-        # Extract items by searching menu
+        if "pronoun" in intents and assistant_response:
+            if response_scan is None:
+                response_scan = self._scan_response(assistant_response)
+            referenced_items = self._extract_referenced_item(message_lower, *response_scan)
+            if referenced_items:
+                return referenced_items
+
+        return self._extract_explicit_items(message_lower)
+
+    def _scan_response(self, response: str) -> Tuple[str, Set[int]]:
+        """Folded response and the indices of the menu items it names"""
+        response_lower = _fold(response)
+        return response_lower, self._index.name_matcher.find(response_lower)
+
+    def _extract_confirmed_items(self, response: str, response_lower: str, mentioned: Set[int]) -> List[Dict]:
+        """
+        Items suggested in the assistant response, for an implicit confirmation
+        response_lower is the folded response and mentioned the items it names
+        """
         found_items = []
-        
-        # Support both old and new format
-        sections = self.menu.get("sezioni", [])
-        if sections:
-            # New format
-            for sezione in sections:
-                for item in sezione.get('voci', []):
-                    item_name = item["nome"].lower()
-                    
-                    # Check if item name appears in message
-                    # Use partial matching for better results
-                    words_in_message = set(message_lower.split())
-                    words_in_item = set(item_name.split())
-                    
-                    # Check for direct mention or key words match
-                    if (item_name in message_lower or 
+        found_names = set()
+        # Already ordered items are skipped to avoid duplicates
+        has_name = self.order.has_name
+
+        # Index columns bound to locals for the loop over the whole menu
+        index = self._index
+        menu_items = index.menu_items
+        word_bits_get = index.word_bits.get
+
+        response_bits = 0
+        for word in response_lower.split():
+            response_bits |= word_bits_get(word, 0)
+        for idx, (item_name, name_bits) in enumerate(zip(index.names_lower, index.meaningful_bits)):
+            # Skip if already in order or already in found_items
+            if item_name in found_names or has_name(item_name):
+                continue
+            # Check if mentioned in response (exact match), or fuzzy matching
+            # per vini (es. "Vermentino" → "Vermentino di Gallura"): almeno una
+            # parola del nome (escluse parole comuni) è nella risposta
+            if idx in mentioned or name_bits & response_bits:
+                found_items.append({"nome": menu_items[idx][1]["nome"], "taglia": None})
+                found_names.add(item_name)
+
+        if found_items:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("✨ Conferma implicita: aggiungo suggeriti: %s", [f['nome'] for f in found_items])
+            return found_items
+
+        # SOLO se non ha trovato nulla nel menu, cerca voci personalizzate (vini generici, bevande)
+        # Pattern per vini generici: "vino [nome]", "calice di [nome]"
+        logger.debug("⚠️ Nessun item trovato nel menu, cerco voci personalizzate...")
+        custom_items = []
+        # Matches grouped by pattern ("vino" first), in text order within each
+        # Il nome del vino mantiene gli accenti ("Vino Rosé"), i controlli usano la forma senza
+        for match in sorted(_WINE_RE.finditer(response.lower()), key=lambda m: m.lastindex):
+            wine_name = match.group(match.lastindex).capitalize()
+            wine_folded = _fold(wine_name)
+            if not has_name(wine_folded):
+                # Verifica che non sia già nel menu (controllo doppio)
+                found_in_menu = self._index.menu_has_sections and any(
+                    wine_folded in name for name in self._index.names_lower
+                )
+
+                if not found_in_menu:
+                    # Crea voce personalizzata per il vino
+                    custom_item = {
+                        "nome": f"Vino {wine_name}",
+                        "taglia": None,
+                        "prezzo": 0.0,  # Prezzo da definire
+                        "custom": True
+                    }
+                    custom_items.append(custom_item)
+                    logger.debug("🍷 Creata voce personalizzata: %s (prezzo da verificare)", custom_item['nome'])
+
+        return custom_items
+
+    def _extract_referenced_item(self, message_lower: str, response_lower: str,
+                                 mentioned: Set[int]) -> List[Dict]:
+        """The item a pronoun refers to: the first menu item named in the response"""
+        if not mentioned:
+            return []
+
+        item = self._index.menu_items[min(mentioned)][1]
+        taglia = None
+        if self._index.menu_has_sections and 'taglie' in item:
+            taglia = _size_from_message(message_lower)
+        logger.debug("✨ Riferimento pronominale rilevato: '%s' (dal contesto)", item['nome'])
+        return [{"nome": item["nome"], "taglia": taglia}]
+
+    def _extract_explicit_items(self, message_lower: str) -> List[Dict]:
+        """Items named in the message: at most one per section/category"""
+        found_items = []
+        matched_sections = set()
+        mentioned = self._index.name_matcher.find(message_lower)
+        words_in_message = set(message_lower.split())
+        for idx, (_, item) in enumerate(self._index.menu_items):
+            section = self._index.section_ids[idx]
+            if section in matched_sections:
+                continue
+            if self._index.menu_has_sections:
+                # Check for direct mention or key words match
+                words_in_item = self._index.name_words[idx]
+                if not (idx in mentioned or
                         len(words_in_item & words_in_message) >= min(2, len(words_in_item))):
-                        
-                        # Determine size if applicable
-                        taglia = None
-                        if 'taglie' in item:
-                            if 'grande' in message_lower or 'grosso' in message_lower:
-                                taglia = 'grande'
-                            elif 'piccolo' in message_lower:
-                                taglia = 'piccolo'
-                            else:
-                                taglia = 'piccolo'  # Default
-                        
-                        found_items.append({"nome": item["nome"], "taglia": taglia})
-                        break  # Only match once per section
-        else:
-            # Old format
-            for categoria, items in self.menu.get("categorie", {}).items():
-                for item in items:
-                    item_name = item["nome"].lower()
-                    if item_name in message_lower:
-                        found_items.append({"nome": item["nome"], "taglia": None})
-                        break
-        
+                    continue
+
+                # Determine size if applicable
+                taglia = _size_from_message(message_lower) if 'taglie' in item else None
+            else:
+                if idx not in mentioned:
+                    continue
+                taglia = None
+
+            found_items.append({"nome": item["nome"], "taglia": taglia})
+            matched_sections.add(section)
+
         return found_items
 
     def _find_menu_item(self, item_name: str, taglia: str = None, custom_price: float = None) -> Optional[Dict]:
         """Find menu item by name and optional size, or create custom item"""
-        item_name_lower = item_name.lower()
-        
         # Check if it's a custom item (e.g., wine not in menu)
         if custom_price is not None:
             return {
@@ -447,82 +852,246 @@ Inizia salutando il cliente e chiedendo cosa desidera ordinare."""
                 'id': item_name,
                 'custom': True
             }
-        
-        # Search in new format (sezioni)
-        sections = self.menu.get("sezioni", [])
-        if sections:
-            for sezione in sections:
-                for item in sezione.get('voci', []):
-                    if item_name_lower in item["nome"].lower() or item["nome"].lower() in item_name_lower:
-                        # Handle items with sizes
-                        if 'taglie' in item and taglia:
-                            for t in item['taglie']:
-                                if taglia.lower() in t['nome'].lower():
-                                    return {
-                                        **item,
-                                        'nome': f"{item['nome']} ({t['nome']})",
-                                        'prezzo': t['prezzo'],
-                                        'id': f"{item['nome']}_{t['nome']}"
-                                    }
-                            # If size not found, use first
-                            t = item['taglie'][0]
-                            return {
-                                **item,
-                                'nome': f"{item['nome']} ({t['nome']})",
-                                'prezzo': t['prezzo'],
-                                'id': f"{item['nome']}_{t['nome']}"
-                            }
-                        elif 'prezzo' in item:
-                            if 'id' not in item:
-                                item['id'] = item['nome']
-                            return item
-        
-        # Search in old format (categorie)
-        for categoria, items in self.menu.get("categorie", {}).items():
-            for item in items:
-                if item_name_lower in item["nome"].lower() or item["nome"].lower() in item_name_lower:
-                    return item
-        
+
+        # Exact name first (the extraction returns menu names as they are)
+        idx = self._index.index_by_name.get(_fold(item_name))
+        if idx is not None:
+            menu_item = self._order_ready_item(idx, taglia)
+            if menu_item is not None:
+                return menu_item
+
+        # Then the first name containing (or contained in) it; accents are kept
+        # here, so short names like "tè" don't match inside other words
+        item_name_lower = item_name.lower()
+        for idx, (_, item) in enumerate(self._index.menu_items):
+            name_lower = item["nome"].lower()
+            if item_name_lower in name_lower or name_lower in item_name_lower:
+                menu_item = self._order_ready_item(idx, taglia)
+                if menu_item is not None:
+                    return menu_item
+
         return None
 
-    def chat(self, user_message: str) -> str:
+    def _order_ready_item(self, idx: int, taglia: Optional[str]) -> Optional[Dict]:
+        """Order entry of a menu item for the requested size (None if it can't be ordered as is)"""
+        sizes = self._index.size_variants[idx]
+        if sizes and taglia:
+            taglia_lower = taglia.lower()
+            # If size not found, use first
+            return next((variant for size_lower, variant in sizes if taglia_lower in size_lower), sizes[0][1])
+        return self._index.plain_items[idx]
+
+    def chat(self, user_message: str, fastpath: Optional[bool] = None) -> str:
         """
         Process user message and generate response
 
         Args:
-            user_message: Message from the customer
+            user_message: Message            user_message: Message from the customer
+            fastpath: Override enable_fastpath for this message only
+nt's response
+        """
+        message_lower, response = self._start_turn(user_message, fastpath)
+        if response is not None:
+            return response
+        messages = self._request_messages(user_message, message_lower)
+
+        # Generate response
+        try:
+            response = self.llm.generate(messages, temperature=0.8)
+        except Exception as e:
+            response = _error_reply(e)
+
+        self._finish_turn(user_message, response, message_lower)
+        return response
+
+    def chat_stream(self, user_message: str, fastpath: Optional[bool] = None) -> Iterator[str]:
+        """
+        Process user message and stream the response as it is generated
+
+        Args:
+            user_message: Message            user_message: Message from the customer
+            fastpath: Override enable_fastpath for this message only
+ks of the agent's response; menu items are matched sentence
+            by sentence as they arrive and the order is updated once the
+            full response has been received
+        """
+        message_lower, response = self._start_turn(user_message, fastpath)
+        if response is not None:
+            yield response
+            return
+        messages = self._request_messages(user_message, message_lower)
+
+        chunks = []
+        scan = _StreamScan(self._index.name_matcher)
+        try:
+            for chunk in self.llm.generate_stream(messages, temperature=0.8):
+                chunks.append(chunk)
+                scan.feed(chunk)
+                yield chunk
+        except Exception as e:
+            error = _error_reply(e)
+            chunks.append(error)
+            scan.feed(error)
+            yield error
+
+        self._finish_turn(user_message, "".join(chunks), message_lower, scan.finish())
+
+    async def achat(self, user_message: str, fastpath: Optional[bool] = None) -> str:
+        """
+        Process user message like chat(), awaiting the LLM without blocking the event loop
+
+        Args:
+            user_message: Message            user_message: Message from the customer
+            fastpath: Override enable_fastpath for this message only
+nt's response
+        """
+        message_lower, response = self._start_turn(user_message, fastpath)
+        if response is not None:
+            return response
+
+        await self._acompact_history()
+        messages = self._prepare_messages(user_message, message_lower)
+
+        try:
+            response = await self.llm.agenerate(messages, temperature=0.8)
+        except Exception as e:
+            response = _error_reply(e)
+
+        self._finish_turn(user_message, response, message_lower)
+        return response
+
+    @staticmethod
+    def batch_chat(agents: List["WaiterAgent"], user_messages: List[str]) -> List[str]:
+        """
+        Process one message per agent (e.g. one per table) with a single batched LLM call
+
+        Args:
+            agents: Agents sharing the same LLM provider
+            user_messages: Message for each agent, in the same order
 
         Returns:
-            Agent's response
+            Response of each agent
+        """
+        responses: List[Optional[str]] = [None] * len(agents)
+        pending = []
+        for i, (agent, user_message) in enumerate(zip(agents, user_messages)):
+            message_lower, responses[i] = agent._start_turn(user_message)
+            if responses[i] is None:
+                pending.append((i, message_lower))
+
+        # History summaries that are due, sent as one batch before the turns
+        compactions = []
+        for i, _ in pending:
+            request = agents[i]._compaction_request()
+            if request is not None:
+                compactions.append((agents[i], request))
+        if compactions:
+            try:
+                summaries = agents[0].llm.batch_generate(
+                    [request for _, request in compactions], max_tokens=200, temperature=0.3
+                )
+            except Exception as e:
+                for agent, _ in compactions:
+                    agent._compaction_failed(e)
+            else:
+                for (agent, _), summary in zip(compactions, summaries):
+                    agent._apply_compaction(summary)
+
+        pending = [
+            (i, message_lower, agents[i]._prepare_messages(user_messages[i], message_lower))
+            for i, message_lower in pending
+        ]
+        if pending:
+            try:
+                generated = agents[0].llm.batch_generate([messages for _, _, messages in pending], temperature=0.8)
+            except Exception as e:
+                generated = [_error_reply(e)] * len(pending)
+
+            for (i, message_lower, _), response in zip(pending, generated):
+                agents[i]._finish_turn(user_messages[i], response, message_lower)
+                responses[i] = response
+
+        return responses
+
+    def _start_turn(self, user_message: str, fastpath: Optional[bool] = None) -> Tuple[str, Optional[str]]:
+        """
+        Folded user message, and the fast-path reply (already recorded in the
+        history) if the message doesn't need the LLM, None otherwise
         """
+        message_lower = _fold(user_message)
+        if fastpath is None:
+            fastpath = self.enable_fastpath
+        if fastpath:
+            response = self._fastpath_reply(message_lower)
+            if response is not None:
+                self._record_exchange(user_message, response)
+                return message_lower, response
+        return message_lower, None
+
+    def _request_messages(self, user_message: str, message_lower: str) -> List[Dict[str, str]]:
+        """Compact the history if due, then build the LLM messages of this turn"""
+        self._compact_history()
+        return self._prepare_messages(user_message, message_lower)
+
+    def _fastpath_reply(self, message_lower: str) -> Optional[str]:
+        """Answer trivial messages (greetings, bill) directly, None otherwise"""
+        stripped = message_lower.strip().rstrip("!?.,")
+        if stripped in _FASTPATH_REPLIES:
+            return _FASTPATH_REPLIES[stripped]
+
+        if stripped in _BILL_PHRASES:
+            return self.order.get_summary()
+
+        return None
+
+    def _prepare_messages(self, user_message: str, message_lower: str) -> List[Dict[str, str]]:
+        """Update preferences from the user message and build the LLM messages"""
         # Detect and update customer preferences
-        self._extract_preferences(user_message)
+        self._extract_preferences(message_lower)
 
-        # Build messages for LLM
+        # Build messages for LLM: the static system prompt is always the
+        # first message, so providers can reuse their prompt-prefix cache
         messages = [{"role": "system", "content": self.system_prompt}]
 
-        # Add context about current state
+        # Summary of the older, compacted part of the conversation
+        if self._history_summary:
+            messages.append({
+                "role": "system",
+                "content": f"RIASSUNTO DELLA CONVERSAZIONE PRECEDENTE:\n{self._history_summary}"
+            })
+
+        # Current user message, with the context about current state
+        # (order, preferences) carried by this turn instead of the prefix
         context = self._build_context_message()
         if context:
-            messages.append({"role": "system", "content": context})
+            user_turn = {"role": "user", "content": f"{context.strip()}\n\n{user_message}"}
+        else:
+            user_turn = {"role": "user", "content": user_message}
 
-        # Add conversation history (last 10 messages to avoid context overflow)
-        messages.extend(self.conversation_history[-10:])
+        # Add the most recent history messages that fit in the token budget
+        budget = (self.prompt_token_budget - RESPONSE_TOKEN_RESERVE
+                  - sum(_count_tokens(msg["content"]) for msg in messages)
+                  - _count_tokens(user_turn["content"]))
+        kept = 0
+        for msg in reversed(self.conversation_history):
+            budget -= _count_tokens(msg["content"])
+            if budget < 0:
+                break
+            kept += 1
+        if kept:
+            messages.extend(list(self.conversation_history)[-kept:])
 
-        # Add current user message
-        messages.append({"role": "user", "content": user_message})
-
-        # Generate response
-        try:
-            response = self.llm.generate(messages, temperature=0.8)
-        except Exception as e:
-            response = f"Mi scuso, ho avuto un problema tecnico. Può ripetere per favore? (Errore: {e})"
+        messages.append(user_turn)
+        return messages
 
+    def _finish_turn(self, user_message: str, response: str, message_lower: str,
+                     response_scan: Optional[Tuple[str, Set[int]]] = None):
+        """Add the ordered items and record the exchange in the history"""
         # Extract and add ordered items using LLM
-        ordered_items = self._extract_order_with_llm(user_message, response)
+        ordered_items = self._extract_order_with_llm(user_message, response, message_lower, response_scan)
         
         if ordered_items:
-            print(f"🔍 Items estratti dall'LLM: {ordered_items}")
+            logger.debug("🔍 Items estratti dall'LLM: %s", ordered_items)
             for item_data in ordered_items:
                 item_name = item_data.get('nome', '')
                 taglia = item_data.get('taglia')
@@ -533,101 +1102,124 @@ Inizia salutando il cliente e chiedendo cosa desidera ordinare."""
                 
                 if menu_item:
                     # Check if not already in order
-                    item_id = menu_item.get('id', menu_item['nome'])
-                    if not any(order_item["item"].get("id") == item_id for order_item in self.order.items):
+                    if _order_item_id(menu_item) not in self.order:
                         self.order.add_item(menu_item)
                         if menu_item.get('custom'):
-                            print(f"✅ Aggiunto all'ordine: {menu_item['nome']} - €{menu_item.get('prezzo', 0):.2f} (prezzo da verificare)")
+                            logger.debug("✅ Aggiunto all'ordine: %s - €%.2f (prezzo da verificare)", menu_item['nome'], menu_item.get('prezzo', 0))
                         else:
-                            print(f"✅ Aggiunto all'ordine: {menu_item['nome']} - €{menu_item.get('prezzo', 0):.2f}")
+                            logger.debug("✅ Aggiunto all'ordine: %s - €%.2f", menu_item['nome'], menu_item.get('prezzo', 0))
 
-        # Update conversation history
-        self.conversation_history.append({"role": "user", "content": user_message})
-        self.conversation_history.append({"role": "assistant", "content": response})
+        self._record_exchange(user_message, response)
 
-        return response
+    def _record_exchange(self, user_message: str, response: str):
+        """Update conversation history"""
+        exchange = ({"role": "user", "content": user_message}, {"role": "assistant", "content": response})
+        self.conversation_history.extend(exchange)
+        self._transcript.extend(exchange)
+
+    def _compact_history(self):
+        """
+        Summarize the older messages with the LLM, keeping the last ones verbatim
+        Called before an LLM request (never on the fast path) once the history
+        is past HISTORY_COMPACT_AT messages
+        """
+        request = self._compaction_request()
+        if request is None:
+            return
+        try:
+            summary = self.llm.generate(request, max_tokens=200, temperature=0.3)
+        except Exception as e:
+            self._compaction_failed(e)
+            return
+        self._apply_compaction(summary)
+
+    async def _acompact_history(self):
+        """Like _compact_history, awaiting the summary without blocking the event loop"""
+        request = self._compaction_request()
+        if request is None:
+            return
+        try:
+            summary = await self.llm.agenerate(request, max_tokens=200, temperature=0.3)
+        except Exception as e:
+            self._compaction_failed(e)
+            return
+        self._apply_compaction(summary)
+
+    def _compaction_request(self) -> Optional[List[Dict[str, str]]]:
+        """LLM messages asking for the summary, None if compaction is not due"""
+        if len(self.conversation_history) <= HISTORY_COMPACT_AT:
+            return None
+        # Back off after a failure instead of retrying on every turn
+        if self._compact_backoff:
+            self._compact_backoff -= 1
+            return None
 
-    def _extract_preferences(self, message: str):
-        """Extract customer preferences from message"""
-        message_lower = message.lower()
+        lines = []
+        if self._history_summary:
+            lines.append(f"Riassunto precedente: {self._history_summary}")
+        for msg in list(self.conversation_history)[:-HISTORY_KEEP_RECENT]:
+            speaker = "Cliente" if msg["role"] == "user" else "Cameriere"
+            lines.append(f"{speaker}: {msg['content']}")
+
+        return [
+            {"role": "system", "content": _SUMMARY_PROMPT},
+            {"role": "user", "content": "\n".join(lines)}
+        ]
+
+    def _apply_compaction(self, summary: str):
+        """Replace the older messages with their summary"""
+        recent = list(self.conversation_history)[-HISTORY_KEEP_RECENT:]
+        self._history_summary = summary.strip()
+        self.conversation_history.clear()
+        self.conversation_history.extend(recent)
+
+    def _compaction_failed(self, error: Exception):
+        """Keep the full history (the token budget still bounds the prompt) and wait before retrying"""
+        logger.warning("⚠️ Riassunto della conversazione non riuscito: %s", error)
+        self._compact_backoff = HISTORY_COMPACT_RETRY_TURNS
+
+    def _extract_preferences(self, message_lower: str):
+        """Extract customer preferences from the (folded) message"""
+        found = _PREFERENCE_MATCHER.find(message_lower)
 
         # Vegetarian/vegan
-        if "vegetariano" in message_lower or "vegetariana" in message_lower:
-            self.customer_preferences["vegetarian"] = True
-        if "vegano" in message_lower or "vegana" in message_lower:
+        if "vegetarian" in found:
             self.customer_preferences["vegetarian"] = True
 
         # Allergies
-        common_allergens = ["glutine", "lattosio", "uova", "solfiti", "frutta secca"]
-        for allergen in common_allergens:
-            if allergen in message_lower and "allergi" in message_lower:
-                if allergen not in self.customer_preferences["allergies"]:
+        if "allergy" in found:
+            for allergen in _COMMON_ALLERGENS:
+                if allergen in found and allergen not in self.customer_preferences["allergies"]:
                     self.customer_preferences["allergies"].append(allergen)
 
         # Spicy preference
-        if "piccante" in message_lower:
-            if "non" in message_lower or "senza" in message_lower:
+        if "spicy" in found:
+            if "negation" in found:
                 self.customer_preferences["spicy_preference"] = "no"
             else:
                 self.customer_preferences["spicy_preference"] = "yes"
 
     def _detect_order_items(self, message: str):
         """Detect if customer is ordering specific items and add them to order"""
-        message_lower = message.lower()
+        message_lower = _fold(message)
 
         # Simple keyword matching for orders
         # In a production system, you might want to use the LLM to extract structured data
-        
-        # Support both old format (categorie) and new format (sezioni)
-        sections = self.menu.get("sezioni", [])
-        if sections:
-            # New format with sezioni
-            for sezione in sections:
-                for item in sezione.get('voci', []):
-                    item_name_lower = item["nome"].lower()
-                    # Check if item name is mentioned
-                    if item_name_lower in message_lower:
-                        # Check for ordering keywords
-                        if any(keyword in message_lower for keyword in ["prendo", "vorrei", "voglio", "ordino", "porto"]):
-                            # For items with sizes, try to detect which size
-                            if 'taglie' in item:
-                                # Try to detect size
-                                if 'grande' in message_lower:
-                                    taglia = next((t for t in item['taglie'] if 'grande' in t['nome'].lower()), item['taglie'][0])
-                                elif 'piccolo' in message_lower:
-                                    taglia = next((t for t in item['taglie'] if 'piccolo' in t['nome'].lower()), item['taglie'][0])
-                                else:
-                                    taglia = item['taglie'][0]  # Default to first size
-                                
-                                # Create item with selected size
-                                item_with_size = {
-                                    **item,
-                                    'nome': f"{item['nome']} ({taglia['nome']})",
-                                    'prezzo': taglia['prezzo'],
-                                    'id': f"{item['nome']}_{taglia['nome']}"
-                                }
-                                # Check if not already in order
-                                if not any(order_item["item"].get("id") == item_with_size["id"] for order_item in self.order.items):
-                                    self.order.add_item(item_with_size)
-                            else:
-                                # Regular item
-                                if 'id' not in item:
-                                    item['id'] = item['nome']  # Use name as ID if not present
-                                # Check if not already in order
-                                if not any(order_item["item"].get("id") == item.get("id") for order_item in self.order.items):
-                                    self.order.add_item(item)
-        else:
-            # Old format with categorie
-            for categoria, items in self.menu.get("categorie", {}).items():
-                for item in items:
-                    item_name_lower = item["nome"].lower()
-                    # Check if item name is mentioned
-                    if item_name_lower in message_lower:
-                        # Check for ordering keywords
-                        if any(keyword in message_lower for keyword in ["prendo", "vorrei", "voglio", "ordino", "porto"]):
-                            # Check if not already in order
-                            if not any(order_item["item"]["id"] == item["id"] for order_item in self.order.items):
-                                self.order.add_item(item)
+        if not _ORDER_KEYWORD_RE.search(message_lower):
+            return
+
+        # One pass over the message finds every mentioned item (in menu order)
+        for idx in sorted(self._index.name_matcher.find(message_lower)):
+            sizes = self._index.size_variants[idx]
+            taglia = None
+            if sizes:
+                # For items with sizes, try to detect which size (default to the first)
+                taglia = next((size for size in ("grande", "piccolo") if size in message_lower), sizes[0][0])
+            menu_item = self._order_ready_item(idx, taglia)
+
+            # Check if not already in order
+            if menu_item is not None and _order_item_id(menu_item) not in self.order:
+                self.order.add_item(menu_item)
 
     def get_order(self) -> Order:
         """Get current order"""
@@ -638,75 +1230,44 @@ Inizia salutando il cliente e chiedendo cosa desidera ordinare."""
         self.order = Order()
 
     def get_conversation_history(self) -> List[Dict[str, str]]:
-        """Get conversation history"""
-        return self.conversation_history
+        """Get the full conversation history"""
+        return list(self._transcript)
 
-    def search_menu(self, query: str, filters: Optional[Dict] = None) -> List[Dict]:
+    def search_menu(self, query: str, filters: Optional[Dict] = None, limit: Optional[int] = None) -> List[Dict]:
         """
         Search menu items based on query and filters
 
         Args:
             query: Search query
             filters: Optional filters (vegetarian, max_price, category, etc.)
+            limit: Return at most this many items, stopping the search there
 
         Returns:
             List of matching items
         """
-        results = []
-        query_lower = query.lower() if query else ""
+        search_args = self._search_args(query, filters)
+        # The index (and its cached results) is shared by all the agents with
+        # this menu: every caller gets its own copy of the items
+        if limit is None:
+            return [dict(item) for item in self._index.search(*search_args)]
+        return [dict(item) for item in islice(self._index.iter_search(*search_args), limit)]
 
-        # Support both old format (categorie) and new format (sezioni)
-        sections = self.menu.get("sezioni", [])
-        if sections:
-            # New format with sezioni
-            for sezione in sections:
-                categoria = sezione['nome']
-                for item in sezione.get('voci', []):
-                    # Apply filters
-                    if filters:
-                        item_prezzo = item.get('prezzo', 0)
-                        if 'taglie' in item:
-                            item_prezzo = min(t['prezzo'] for t in item['taglie'])
-                        
-                        if filters.get("vegetarian") and not item.get("vegetariano"):
-                            continue
-                        if filters.get("max_price") and item_prezzo > filters["max_price"]:
-                            continue
-                        if filters.get("category") and categoria != filters["category"]:
-                            continue
-                        if filters.get("exclude_allergens"):
-                            if any(allergen in item.get("allergeni", []) for allergen in filters["exclude_allergens"]):
-                                continue
-
-                    # Search in name and description
-                    if query_lower:
-                        if (query_lower in item["nome"].lower() or
-                            query_lower in item.get("descrizione", "").lower()):
-                            results.append({**item, "categoria": categoria})
-                    else:
-                        results.append({**item, "categoria": categoria})
-        else:
-            # Old format with categorie
-            for categoria, items in self.menu.get("categorie", {}).items():
-                for item in items:
-                    # Apply filters
-                    if filters:
-                        if filters.get("vegetarian") and not item.get("vegetariano"):
-                            continue
-                        if filters.get("max_price") and item["prezzo"] > filters["max_price"]:
-                            continue
-                        if filters.get("category") and categoria != filters["category"]:
-                            continue
-                        if filters.get("exclude_allergens"):
-                            if any(allergen in item.get("allergeni", []) for allergen in filters["exclude_allergens"]):
-                                continue
-
-                    # Search in name and description
-                    if query_lower:
-                        if (query_lower in item["nome"].lower() or
-                            query_lower in item.get("descrizione", "").lower()):
-                            results.append({**item, "categoria": categoria})
-                    else:
-                        results.append({**item, "categoria": categoria})
+    def iter_search_menu(self, query: str, filters: Optional[Dict] = None) -> Iterator[Dict]:
+        """Like search_menu, but yields the matching items as they are found"""
+        return map(dict, self._index.iter_search(*self._search_args(query, filters)))
+
+    def _search_args(self, query: str, filters: Optional[Dict]) -> Tuple[Any, ...]:
+        """Lowercase query and filter values, as taken by the menu index searches"""
+        query_lower = query.lower() if query else ""
 
-        return results
+        filters = filters or {}
+        category = filters.get("category")
+        if isinstance(category, str):
+            category = sys.intern(category)
+        return (
+            query_lower,
+            filters.get("vegetarian"),
+            filters.get("max_price"),
+            category,
+            self._index.allergen_mask(filters.get("exclude_allergens") or ()),
+        )